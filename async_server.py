@@ -0,0 +1,138 @@
+import asyncio
+import collections
+import threading
+
+import websockets
+import bson
+
+from server import ServerBase
+
+# messages that can be skipped when a client falls behind, newer ones will follow
+DROPPABLE = {"status", "progress", "preview"}
+
+class AsyncServer(ServerBase):
+    class Connection():
+        def __init__(self, server, websocket):
+            self.server = server
+            self.websocket = websocket
+            self.id = None
+
+            self.queue = collections.deque()
+            self.queued = 0
+            self.ready = asyncio.Event()
+            self.closed = False
+
+        def enqueue(self, type, data):
+            if self.closed:
+                return
+
+            # backpressure, skip updates once the client is behind and give up on clients that stop reading
+            if self.queued + len(data) > self.server.send_limit:
+                if type in DROPPABLE:
+                    return
+                if self.queued + len(data) > self.server.close_limit:
+                    self.close()
+                    return
+
+            self.queue.append(data)
+            self.queued += len(data)
+            self.ready.set()
+
+        def close(self):
+            self.closed = True
+            self.ready.set()
+            asyncio.ensure_future(self.websocket.close())
+
+        async def sender(self):
+            while not self.closed:
+                await self.ready.wait()
+                self.ready.clear()
+                while self.queue and not self.closed:
+                    data = self.queue.popleft()
+                    self.queued -= len(data)
+                    try:
+                        await self.websocket.send(data)
+                    except websockets.ConnectionClosed:
+                        self.closed = True
+
+        def send_error(self, error):
+            response = {"type": "error", "data": {"message":error}}
+            self.enqueue("error", bson.dumps(response))
+
+    def __init__(self, wrappers, host, port, send_limit=2**24, close_limit=2**28, max_size=2**27, stats_interval=0):
+        super().__init__(wrappers, stats_interval)
+        self.host = host
+        self.port = int(port)
+
+        # per connection limits on queued bytes and the largest accepted request
+        self.send_limit = send_limit
+        self.close_limit = close_limit
+        self.max_size = max_size
+
+        self.loop = None
+        self.stopping = None
+        self.serve = threading.Thread(target=self.serve_forever)
+
+    def start(self):
+        print("SERVER: starting")
+        self.start_workers()
+        self.serve.start()
+
+    def stop(self):
+        print("SERVER: stopping")
+        self.clients = {}
+        self.stop_workers()
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.stopping.set)
+        self.join()
+
+    def join(self):
+        self.join_workers()
+        self.serve.join()
+
+    def serve_forever(self):
+        asyncio.run(self.main())
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        async with websockets.serve(self.handle, self.host, self.port, max_size=self.max_size):
+            await self.stopping.wait()
+
+    async def handle(self, websocket, path=None):
+        connection = AsyncServer.Connection(self, websocket)
+        connection.id = self.on_connected(connection)
+        sender = asyncio.ensure_future(connection.sender())
+        try:
+            async for message in websocket:
+                try:
+                    request = bson.loads(message)
+                    assert type(request["type"]) == str
+                    assert type(request["data"]) == dict
+                except Exception:
+                    connection.send_error("malformed request")
+                    continue
+                connection.id = self.on_request(connection.id, request)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            connection.closed = True
+            connection.ready.set()
+            await sender
+            if connection.id in self.clients:
+                self.on_disconnected(connection.id)
+
+    def on_response(self, id, response):
+        connection = self.clients.get(id)
+        if not connection:
+            return False
+
+        # serialize on the calling thread, the event loop only moves bytes
+        data = bson.dumps(response)
+        self.loop.call_soon_threadsafe(self.deliver, id, response["type"], data)
+        return True
+
+    def deliver(self, id, type, data):
+        connection = self.clients.get(id)
+        if connection:
+            connection.enqueue(type, data)
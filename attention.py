@@ -17,6 +17,9 @@ def default(val, d):
 
 def use_split_attention():
     def get_available_vram(device):
+        # only cuda devices are sliced, cpu workers compute attention in one go
+        if device.type != "cuda":
+            return float("inf")
         stats = torch.cuda.memory_stats(device)
         mem_active = stats['active_bytes.all.current']
         mem_reserved = stats['reserved_bytes.all.current']
@@ -260,7 +263,12 @@ def use_flash_attention():
 def use_xformers_attention():
     import xformers
 
+    # xformers only runs on cuda, cpu workers keep the default attention
+    default_forward = diffusers.models.attention.CrossAttention.forward
+
     def xformers_attention_forward(self, x, encoder_hidden_states=None, attention_mask=None):
+        if x.device.type != "cuda":
+            return default_forward(self, x, encoder_hidden_states, attention_mask)
         h = self.heads
         q_in = self.to_q(x)
         context = default(encoder_hidden_states, x)
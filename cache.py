@@ -0,0 +1,168 @@
+import os
+import glob
+import json
+import hashlib
+import threading
+import collections
+import PIL.Image
+
+def canonicalize(value):
+    if type(value) == bool or value == None or type(value) == str:
+        return value
+    if type(value) in [int, float]:
+        return float(value)
+    if type(value) in [list, tuple]:
+        return [canonicalize(v) for v in value]
+    if type(value) == dict:
+        return {str(k): canonicalize(v) for k, v in value.items()}
+    if isinstance(value, PIL.Image.Image):
+        return {"image": hashlib.sha256(value.tobytes()).hexdigest(), "size": list(value.size), "mode": value.mode}
+    raise ValueError(f"ERROR uncacheable parameter: {type(value)}")
+
+def get_key(params):
+    params = json.dumps(canonicalize(params), sort_keys=True)
+    return hashlib.sha256(params.encode("utf-8")).hexdigest()
+
+def get_size(images):
+    return sum(i.size[0] * i.size[1] * len(i.getbands()) for i in images)
+
+class ResultCache():
+    def __init__(self, path, memory_limit=2**30, disk_limit=2**33):
+        self.path = path
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+
+        # key -> images, key -> (count, bytes), both in least recently used order
+        self.memory = collections.OrderedDict()
+        self.memory_size = 0
+        self.disk = collections.OrderedDict()
+        self.disk_size = 0
+
+        # keys being generated, identical jobs wait on these instead of generating again
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self.path, exist_ok=True)
+        self.scan()
+
+    def scan(self):
+        files = sorted(glob.glob(os.path.join(self.path, "*.png")), key=os.path.getmtime)
+        for file in files:
+            key = os.path.basename(file).split(".")[0]
+            count, size = self.disk.get(key, (0, 0))
+            self.disk[key] = (count + 1, size + os.path.getsize(file))
+            self.disk_size += os.path.getsize(file)
+
+    def get_files(self, key, count):
+        return [os.path.join(self.path, f"{key}.{i}.png") for i in range(count)]
+
+    def read_disk(self, key, count):
+        try:
+            images = []
+            for file in self.get_files(key, count):
+                os.utime(file)
+                with PIL.Image.open(file) as image:
+                    images += [image.copy()]
+            return images
+        except Exception:
+            return None
+
+    def get(self, key):
+        # returns cached images, or None if the caller should generate them and then call put/cancel.
+        # files are read and written outside the lock, so one workers I/O doesnt hold up the others
+        while True:
+            with self.lock:
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    self.hits += 1
+                    return self.memory[key]
+                event = self.inflight.get(key)
+                if not event:
+                    self.inflight[key] = threading.Event()
+                    if not key in self.disk:
+                        self.misses += 1
+                        return None
+                    self.disk.move_to_end(key)
+                    count = self.disk[key][0]
+
+            if event:
+                event.wait()
+                continue
+
+            # identical jobs wait while the images are read back
+            images = self.read_disk(key, count)
+            removed = []
+            with self.lock:
+                if images != None:
+                    self.hits += 1
+                    self.store_memory(key, images)
+                    self.release(key)
+                    return images
+                if key in self.disk:
+                    removed = [self.remove_disk(key)]
+                self.misses += 1
+                # the caller generates them instead
+                break
+        self.delete_files(removed)
+        return None
+
+    def put(self, key, images):
+        with self.lock:
+            self.store_memory(key, images)
+            self.release(key)
+            if key in self.disk:
+                return
+
+        files = self.get_files(key, len(images))
+        try:
+            for image, file in zip(images, files):
+                image.save(file, format="PNG", compress_level=1)
+            size = sum(os.path.getsize(f) for f in files)
+        except Exception:
+            self.delete_files([files])
+            return
+
+        removed = []
+        with self.lock:
+            if not key in self.disk:
+                self.disk[key] = (len(images), size)
+                self.disk_size += size
+            while self.disk_size > self.disk_limit and len(self.disk) > 1:
+                removed += [self.remove_disk(next(iter(self.disk)))]
+        self.delete_files(removed)
+
+    def cancel(self, key):
+        with self.lock:
+            self.release(key)
+
+    def release(self, key):
+        if key in self.inflight:
+            self.inflight[key].set()
+            del self.inflight[key]
+
+    def store_memory(self, key, images):
+        size = get_size(images)
+        if size > self.memory_limit:
+            return
+        if key in self.memory:
+            self.memory_size -= get_size(self.memory[key])
+        self.memory[key] = images
+        self.memory_size += size
+        while self.memory_size > self.memory_limit:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_size -= get_size(evicted)
+
+    def remove_disk(self, key):
+        # returns the files to delete once the lock is released
+        count, size = self.disk.pop(key)
+        self.disk_size -= size
+        return self.get_files(key, count)
+
+    def delete_files(self, removed):
+        for files in removed:
+            for file in files:
+                if os.path.exists(file):
+                    os.remove(file)
@@ -22,9 +22,11 @@ if __name__ == "__main__":
             response = bson.loads(response)
             
             if response["type"] == "result":
-                for i, image_data in enumerate(response["data"]["images"]):
+                for image_data in response["data"]["images"]:
                     image = PIL.Image.open(io.BytesIO(image_data))
-                    image.save(f"client_{i}.png")
+                    image.save(f"client_{response['data']['index']}.png")
+                response["data"] = "..."
+            if response["type"] == "preview":
                 response["data"] = "..."
             print(response)
 
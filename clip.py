@@ -24,16 +24,20 @@ class CustomCLIPTextTransformer(CLIPTextTransformer):
         output_hidden_states = output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
 
+        # a single sequence or a batch of equal length sequences
+        if input_ids and type(input_ids[0]) in [list, tuple]:
+            sequences = input_ids
+        else:
+            sequences = [input_ids]
+
         # tensors are already embedded so bypass the token_embedding
-        tensors = [t if type(t) == torch.Tensor else None for t in input_ids]
-        input_ids = [t if type(t) != torch.Tensor else 0 for t in input_ids]
-        input_ids = torch.tensor([input_ids], dtype=torch.long, device=self.device)
-        
-        inputs_embeds = [e for e in self.embeddings.token_embedding(input_ids)[0]]
-        for i in range(len(inputs_embeds)):
-            if tensors[i] != None:
-                inputs_embeds[i] = tensors[i].to(inputs_embeds[i].dtype)
-        inputs_embeds = torch.stack(inputs_embeds).unsqueeze(0)
+        tensors = [(b, i, t) for b, s in enumerate(sequences) for i, t in enumerate(s) if type(t) == torch.Tensor]
+        input_ids = [[t if type(t) != torch.Tensor else 0 for t in s] for s in sequences]
+        input_ids = torch.tensor(input_ids, dtype=torch.long, device=self.device)
+
+        inputs_embeds = self.embeddings.token_embedding(input_ids)
+        for b, i, t in tensors:
+            inputs_embeds[b, i] = t.to(inputs_embeds.dtype)
 
         position_ids = self.embeddings.position_ids[:, :inputs_embeds.shape[1]]
         position_embeddings = self.embeddings.position_embedding(position_ids)
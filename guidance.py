@@ -1,8 +1,9 @@
 import torch
 
 class GuidedDenoiser():
-    def __init__(self, unet, conditioning_schedule, scale):
+    def __init__(self, unet, conditioning_schedule, scale, interrupt=None):
         self.unet = unet
+        self.interrupt = interrupt
         self.conditioning_schedule = conditioning_schedule
         self.conditioning = self.conditioning_schedule[0]
         self.scale = scale
@@ -32,6 +33,9 @@ class GuidedDenoiser():
         return latents
 
     def predict_noise(self, latents, timestep, alpha):
+        if self.interrupt:
+            self.interrupt()
+
         model_input = torch.cat([latents] * 2)
         conditioning = self.conditioning
 
@@ -66,6 +70,9 @@ class GuidedDenoiser():
         return original_pred
 
     def predict_original(self, latents, timestep, sigma):
+        if self.interrupt:
+            self.interrupt()
+
         model_input = torch.cat([latents] * 2)
         conditioning = self.conditioning
 
@@ -1,4 +1,5 @@
 import os
+import collections
 import torch
 import utils
 
@@ -34,9 +35,9 @@ class SDUNET(SDUNET):
 
         utils.cast_state_dict(state_dict, dtype)
         
-        with utils.DisableInitialization():
+        with utils.DisableInitialization(), utils.EmptyInitialization():
             unet = SDUNET(model_type, prediction_type, dtype)
-            missing, _ = unet.load_state_dict(state_dict, strict=False)
+            missing = utils.load_state_dict(unet, state_dict)
         if missing:
             raise ValueError("ERROR missing keys: " + ", ".join(missing))
 
@@ -71,9 +72,9 @@ class UNET(UNet2DConditionModel):
 
         utils.cast_state_dict(state_dict, dtype)
         
-        with utils.DisableInitialization():
+        with utils.DisableInitialization(), utils.EmptyInitialization():
             unet = UNET(model_type, prediction_type, dtype)
-            missing, _ = unet.load_state_dict(state_dict, strict=False)
+            missing = utils.load_state_dict(unet, state_dict)
         if missing:
             raise ValueError("ERROR missing keys: " + ", ".join(missing))
         
@@ -140,9 +141,9 @@ class VAE(AutoencoderKL):
 
         utils.cast_state_dict(state_dict, dtype)
         
-        with utils.DisableInitialization():
+        with utils.DisableInitialization(), utils.EmptyInitialization():
             vae = VAE(model_type, dtype)
-            missing, _ = vae.load_state_dict(state_dict, strict=False)
+            missing = utils.load_state_dict(vae, state_dict)
         if missing:
             raise ValueError("missing keys: " + missing)
         return vae
@@ -172,6 +173,12 @@ class CLIP(CustomCLIP):
 
         self.tokenizer = Tokenizer(model_type)
         self.additional = None
+
+        # tokenized names, with a trie over them for matching in prompts, vectors come from the loader
+        self.textual_inversions = []
+        self.textual_inversion_names = []
+        self.textual_inversion_trie = {}
+        self.textual_inversion_loader = None
         
     def autocast(self):
         return "cuda" if "cuda" in str(self.device) else "cpu"
@@ -184,9 +191,9 @@ class CLIP(CustomCLIP):
 
         utils.cast_state_dict(state_dict, dtype)
         
-        with utils.DisableInitialization():
+        with utils.DisableInitialization(), utils.EmptyInitialization():
             clip = CLIP(model_type, dtype)
-            missing, _ = clip.load_state_dict(state_dict, strict=False)
+            missing = utils.load_state_dict(clip, state_dict)
         if missing:
             raise ValueError("missing keys: " + ', '.join(missing))
 
@@ -241,12 +248,32 @@ class CLIP(CustomCLIP):
             raise ValueError(f"unknown type: {model_type}")
         return config
 
-    def set_textual_inversions(self, embeddings):
+    def set_textual_inversions(self, names, loader):
+        # vectors are only loaded when a prompt uses them, the trie is only rebuilt when the names change
+        self.textual_inversion_loader = loader
+        names = list(names)
+        if names == self.textual_inversion_names:
+            return
+
         tokenized = []
-        for name, vec in embeddings.items():
-            name = tuple(self.tokenizer(name)["input_ids"][1:-1])
-            tokenized += [(name, vec)]
+        trie = {}
+        for index, (name, ids) in enumerate(zip(names, self.tokenizer.tokenize(names))):
+            ids = tuple(ids[1:-1])
+            tokenized += [(ids, name)]
+            if not ids:
+                continue
+            node = trie
+            for t in ids:
+                node = node.setdefault(t, {})
+            # None marks the end of a name, the first embedding with that name is used
+            node.setdefault(None, index)
+
         self.textual_inversions = tokenized
+        self.textual_inversion_names = names
+        self.textual_inversion_trie = trie
+
+    def get_textual_inversion(self, index):
+        return self.textual_inversion_loader(self.textual_inversions[index][1])
 
 class Tokenizer():
     def __init__(self, model_type):
@@ -258,9 +285,25 @@ class Tokenizer():
         self.pad_token_id = self.eos_token_id if model_type == "SDv1" else 0
         self.comma_token_id = 267
 
+        # token ids of recently seen prompt fragments
+        self.cache = collections.OrderedDict()
+        self.cache_limit = 4096
+
     def __call__(self, texts):
         return self.tokenizer(texts)
 
+    def tokenize(self, texts):
+        missing = list(set(t for t in texts if not t in self.cache))
+        if missing:
+            for text, ids in zip(missing, self.tokenizer(missing)["input_ids"]):
+                self.cache[text] = ids
+        for text in texts:
+            self.cache.move_to_end(text)
+        result = [self.cache[t] for t in texts]
+        while len(self.cache) > self.cache_limit:
+            self.cache.popitem(last=False)
+        return result
+
 class LoRA(LoRANetwork):
     @staticmethod
     def from_model(state_dict, dtype=None):
@@ -1,5 +1,8 @@
 import lark
 import torch
+import collections
+import functools
+import math
 
 class WeightedTree(lark.Tree):
     pass
@@ -20,6 +23,23 @@ plain: /([^\\\[\]():|]|\\.)+/
 %import common.SIGNED_NUMBER -> NUMBER
 """, tree_class=WeightedTree)
 
+@functools.lru_cache(maxsize=256)
+def parse_tree(prompt):
+    # trees are shared between jobs and workers so they must not be modified
+    return prompt_grammar.parse(prompt)
+
+def get_change_points(tree, steps):
+    # steps where a scheduled node switches, and the period that alternate nodes cycle with
+    points, period = {steps}, 1
+    for node in tree.iter_subtrees():
+        if node.data == "scheduled":
+            specifier = node.children[2].children[0]
+            if specifier != "HR" and 1 <= math.floor(float(specifier)) < steps:
+                points.add(math.floor(float(specifier)))
+        if node.data == "alternate":
+            period = period * len(node.children) // math.gcd(period, len(node.children))
+    return sorted(points, reverse=True), period
+
 def parse_prompt(prompt, steps, HR=False):
     if not prompt:
         return [(steps, [["", 1.0]])]
@@ -27,12 +47,11 @@ def parse_prompt(prompt, steps, HR=False):
     def extract(tree, step, HR=False):
         def propagate(node, output, step, HR, weight):
             if type(node) == WeightedTree:
-                node.weight = weight
                 children = node.children
-                if node.data == "emphasis": node.weight *= 1.1
-                if node.data == "deemphasis": node.weight /= 1.1
+                if node.data == "emphasis": weight *= 1.1
+                if node.data == "deemphasis": weight /= 1.1
                 if node.data == "numeric":
-                    node.weight *= float(node.children[1])
+                    weight *= float(node.children[1])
                     children = [node.children[0]]
                 if node.data == "scheduled":
                     specifier = node.children[2].children[0]
@@ -49,7 +68,7 @@ def parse_prompt(prompt, steps, HR=False):
                 if node.data == "alternate":
                     children = [children[step%len(children)]]
                 for child in children:
-                    propagate(child, output, step, HR, node.weight)
+                    propagate(child, output, step, HR, weight)
             elif node:
                 if output and output[-1][1] == weight:
                     output[-1][0] += str(node)
@@ -59,13 +78,22 @@ def parse_prompt(prompt, steps, HR=False):
         propagate(tree, output, step, HR, 1.0)
         return output
 
-    tree = prompt_grammar.parse(prompt)
+    tree = parse_tree(prompt)
+
+    # the prompt is constant between change points, apart from alternation, so the tree
+    # only needs walking once per change point and alternation phase rather than per step
+    points, period = get_change_points(tree, steps)
+    lows = points[1:] + [0]
 
     schedules = []
-    for step in range(steps, 0, -1):
-        scheduled = extract(tree, step, HR)
-        if not schedules or tuple(schedules[-1][1]) != tuple(scheduled):
-            schedules += [(step, scheduled)]
+    for high, low in zip(points, lows):
+        extracted = {}
+        for step in range(high, low, -1) if period > 1 else [high]:
+            if not step % period in extracted:
+                extracted[step % period] = extract(tree, step, HR)
+            scheduled = extracted[step % period]
+            if not schedules or tuple(schedules[-1][1]) != tuple(scheduled):
+                schedules += [(step, scheduled)]
     schedules = schedules[::-1]
     return schedules
 
@@ -78,7 +106,7 @@ def tokenize_prompt(clip, parsed):
     leeway = 20 
 
     # tokenize prompt and split it into chunks
-    tokenized = tokenizer([text for text, _ in parsed])["input_ids"]
+    tokenized = tokenizer.tokenize([text for text, _ in parsed])
     tokenized = [tokens[1:-1] for tokens in tokenized] # strip special tokens
 
     # weight the individual tokens
@@ -88,17 +116,27 @@ def tokenize_prompt(clip, parsed):
     tokenized = weighted
 
     # add TI embeddings inline with the tokens (our CLIP handles these separately)
+    # the names trie is walked from each position, where several names match the earliest embedding wins
+    trie = clip.textual_inversion_trie
+    substituted = []
     i = 0
     while i < len(tokenized):
-        for name, vector in clip.textual_inversions:
-            match = tuple([t for t,_ in tokenized[i:i+len(name)]])
-            if match == name:
-                weight = tokenized[i][1]
-                tokenized = tokenized[:i] + [(v, weight) for v in vector] + tokenized[i+len(name):]
-                i += vector.shape[0]
+        node, match = trie, None
+        for j in range(i, len(tokenized)):
+            node = node.get(tokenized[j][0])
+            if node == None:
                 break
+            if None in node and (match == None or node[None] < match[0]):
+                match = (node[None], j + 1)
+        if match:
+            index, end = match
+            weight = tokenized[i][1]
+            substituted += [(v, weight) for v in clip.get_textual_inversion(index)]
+            i = end
         else:
+            substituted += [tokenized[i]]
             i += 1
+    tokenized = substituted
 
     # split tokens into chunks
     chunks = []
@@ -109,7 +147,7 @@ def tokenize_prompt(clip, parsed):
             chunk = tokenized[:chunk_size]
 
             # split on a comma if its close to the end of the chunk
-            commas = [i for i, (c, _) in enumerate(chunk) if c == comma_token and i > chunk_size - leeway]
+            commas = [i for i, (c, _) in enumerate(chunk) if type(c) != torch.Tensor and c == comma_token and i > chunk_size - leeway]
             if commas:
                 chunk = tokenized[:commas[-1]+1]
 
@@ -121,47 +159,103 @@ def tokenize_prompt(clip, parsed):
     
     return chunks
 
-def encode_tokens(clip, chunks, clip_skip=1):
+def get_chunk_key(chunk):
+    # TI vectors are identified by their memory, cached encodings keep them alive so it cant be reused
+    return tuple((t if type(t) != torch.Tensor else (str(t.device), t.data_ptr()), w) for t, w in chunk)
+
+class ConditioningCache():
+    def __init__(self, limit=2**26):
+        self.limit = limit
+        self.size = 0
+
+        # (clip key, clip skip, chunk key) -> (encoding, TI vectors), in least recently used order
+        self.encodings = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if not key in self.encodings:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.encodings.move_to_end(key)
+        return self.encodings[key][0]
+
+    def put(self, key, encoding, chunk):
+        if key in self.encodings:
+            return
+        vectors = [t for t, _ in chunk if type(t) == torch.Tensor]
+        self.encodings[key] = (encoding, vectors)
+        self.size += encoding.numel() * encoding.element_size()
+        while self.size > self.limit and self.encodings:
+            _, (evicted, _) = self.encodings.popitem(last=False)
+            self.size -= evicted.numel() * evicted.element_size()
+
+    def get_stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0, "bytes": self.size, "entries": len(self.encodings)}
+
+def encode_chunks(clip, chunks, clip_skip=1, batch_limit=64, cache=None, cache_key=None):
     tokenizer = clip.tokenizer
 
     start_token = tokenizer.bos_token_id
     end_token = tokenizer.eos_token_id
     padding_token = tokenizer.pad_token_id
 
-    chunk_encodings = []
-
+    # identical chunks (padding, shared negatives) are only encoded once
+    unique = {}
     for chunk in chunks:
-        # add special tokens and padding
-        start = [(start_token, 1.0)]
-        end = [(end_token, 1.0)]
-        padding = [(padding_token, 1.0)] * (75-len(chunk))
-        chunk = start + chunk + end + padding
+        unique.setdefault(get_chunk_key(chunk), chunk)
+
+    # and chunks encoded by earlier jobs not at all, the cache key covers the CLIP and any text encoder LoRAs
+    encodings = {}
+    if cache != None and cache_key != None:
+        for key in unique:
+            encoding = cache.get((cache_key, clip_skip, key))
+            if encoding is not None:
+                encodings[key] = encoding
+    keys = [key for key in unique if not key in encodings]
 
-        tokens, weights = list(zip(*chunk))
+    for i in range(0, len(keys), batch_limit):
+        batch = keys[i:i+batch_limit]
 
-        # encode chunk tokens
+        # add special tokens and padding
+        sequences = []
+        for key in batch:
+            chunk = unique[key]
+            start = [(start_token, 1.0)]
+            end = [(end_token, 1.0)]
+            padding = [(padding_token, 1.0)] * (75-len(chunk))
+            sequences += [start + chunk + end + padding]
+
+        tokens = [[t for t, _ in s] for s in sequences]
+        weights = [[w for _, w in s] for s in sequences]
+
+        # encode all the chunks at once
         encoding = clip.text_model(tokens)
 
         # do clip skip
         encoding = encoding['hidden_states'][-clip_skip]
         encoding = clip.text_model.final_layer_norm(encoding)
-        
+
         # each token has been encoded into its own tensor
         # we weight this tensor with the tokens weight
-        weights = torch.tensor([weights], device=clip.device)
+        weights = torch.tensor(weights, device=clip.device)
         weights = weights.reshape(weights.shape + (1,)).expand(encoding.shape)
 
         # keep the mean the same, lets the weighting operation work somewhat
-        original_mean = encoding.mean()
+        original_mean = encoding.mean(dim=(1,2), keepdim=True)
         encoding = encoding * weights
-        new_mean = encoding.mean()
+        new_mean = encoding.mean(dim=(1,2), keepdim=True)
         encoding = encoding * (original_mean / new_mean)
 
-        chunk_encodings += [encoding]
+        for key, e in zip(batch, encoding):
+            encodings[key] = e.unsqueeze(0)
+            if cache != None and cache_key != None:
+                cache.put((cache_key, clip_skip, key), encodings[key].clone(), unique[key])
 
-    # combine all chunk encodings
-    encoding = torch.hstack(chunk_encodings)
-    return encoding
+    return [encodings[get_chunk_key(chunk)] for chunk in chunks]
 
 class PromptSchedule():
     def __init__(self, prompt, steps, clip, HR):
@@ -173,8 +267,14 @@ class PromptSchedule():
     def pad_to_length(self, max_chunks):
         self.tokenized = [(steps, chunks + [chunks[-1]] * (max_chunks-len(chunks))) for steps, chunks in self.tokenized]
         
-    def encode(self, clip, clip_skip):
-        self.encoded = [(steps, encode_tokens(clip, chunks, clip_skip)) for steps, chunks in self.tokenized]
+    def get_chunks(self):
+        return [chunk for _, chunks in self.tokenized for chunk in chunks]
+
+    def set_encodings(self, encodings):
+        self.encoded = []
+        for steps, chunks in self.tokenized:
+            self.encoded += [(steps, torch.hstack(encodings[:len(chunks)]))]
+            encodings = encodings[len(chunks):]
 
     def get_encoding_at_step(self, step):
         for start, encoding in self.encoded:
@@ -183,8 +283,10 @@ class PromptSchedule():
         return encoding[-1][1]
     
 class ConditioningSchedule():
-    def __init__(self, clip, prompt, negative_prompt, steps, clip_skip, batch_size):
+    def __init__(self, clip, prompt, negative_prompt, steps, clip_skip, batch_size, cache=None, cache_key=None):
         self.clip = clip
+        self.cache = cache
+        self.cache_key = cache_key
         self.prompt = prompt
         self.negative_prompt = negative_prompt
         self.steps = steps
@@ -205,7 +307,14 @@ class ConditioningSchedule():
 
         for p in self.positives + self.negatives:
             p.pad_to_length(max_chunks)
-            p.encode(self.clip, self.clip_skip)
+
+        # every chunk of every prompt and schedule segment is encoded in one batch
+        chunks = [c for p in self.positives + self.negatives for c in p.get_chunks()]
+        encodings = encode_chunks(self.clip, chunks, self.clip_skip, cache=self.cache, cache_key=self.cache_key)
+        for p in self.positives + self.negatives:
+            count = len(p.get_chunks())
+            p.set_encodings(encodings[:count])
+            encodings = encodings[count:]
 
         self.reset()
 
@@ -0,0 +1,215 @@
+import threading
+import queue
+import time
+import heapq
+import collections
+
+PRIORITIES = {"interactive": 0, "bulk": 1}
+
+class Job():
+    def __init__(self, id, request, priority, cost, models):
+        self.id = id
+        self.request = request
+        self.priority = priority
+        self.cost = cost
+        self.models = models
+        self.deferred = False
+        self.position = None
+        self.submitted = time.time()
+
+class Scheduler():
+    def __init__(self, cost, models, callback=None, client_limit=16, queue_limit=256, latency_budget=120, max_deferral=60):
+        self.cost = cost
+        self.models = models
+        self.callback = callback
+
+        # how long a job can be passed over in favour of jobs using the resident models
+        self.max_deferral = max_deferral
+        self.workers = {}
+        self.swaps = 0
+        self.swaps_avoided = 0
+
+        # admission control
+        self.client_limit = client_limit
+        self.queue_limit = queue_limit
+        self.latency_budget = latency_budget
+
+        self.jobs = []
+        self.usage = {}
+        self.rate = None
+
+        self.lock = threading.Condition()
+
+    def put(self, id, request):
+        priority = request.get("priority", "interactive")
+        if type(priority) != str or not priority in PRIORITIES:
+            raise ValueError(f"ERROR unknown priority: {priority}")
+        job = Job(id, request, PRIORITIES[priority], self.cost(request), self.models(request))
+
+        with self.lock:
+            if len(self.jobs) >= self.queue_limit:
+                raise ValueError("ERROR server busy")
+            if len([j for j in self.jobs if j.id == id]) >= self.client_limit:
+                raise ValueError("ERROR too many queued requests")
+
+            # over the latency budget bulk work is deferred, interactive work is rejected
+            if self.get_backlog() > self.latency_budget:
+                if job.priority == PRIORITIES["interactive"]:
+                    if self.get_backlog(job.priority) > self.latency_budget:
+                        raise ValueError("ERROR server busy")
+                else:
+                    job.deferred = True
+
+            # clients that were idle join at the current share instead of catching up
+            active = [self.usage[j.id] for j in self.jobs if j.id in self.usage]
+            if not any(j.id == id for j in self.jobs):
+                self.usage[id] = max(self.usage.get(id, 0), min(active, default=0))
+
+            self.jobs.append(job)
+            updates = self.get_updates()
+            self.lock.notify_all()
+        self.report(updates)
+
+    def get(self, timeout, match=None, resident=None, worker=None):
+        deadline = time.time() + timeout
+        with self.lock:
+            if worker != None:
+                self.workers[worker] = resident
+            others = [r for w, r in self.workers.items() if w != worker]
+
+            while True:
+                job = self.select(self.jobs, self.usage, match, resident, others)
+                if job:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise queue.Empty()
+                self.lock.wait(remaining)
+
+            if resident != None:
+                if self.needs_swap(job, resident):
+                    self.swaps += 1
+                elif self.needs_swap(self.select(self.jobs, self.usage, match), resident):
+                    self.swaps_avoided += 1
+
+            self.jobs.remove(job)
+            self.usage[job.id] = self.usage.get(job.id, 0) + job.cost
+            self.prune()
+            self.undefer()
+            updates = self.get_updates()
+        self.report(updates)
+        return job.id, job.request
+
+    def peek(self, resident=None, worker=None):
+        # the job a worker would most likely take next, without taking it
+        with self.lock:
+            others = [r for w, r in self.workers.items() if w != worker]
+            job = self.select(self.jobs, self.usage, None, resident, others)
+            return job.request if job else None
+
+    def remove(self, id):
+        updates = []
+        with self.lock:
+            removed = [j for j in self.jobs if j.id == id]
+            self.jobs = [j for j in self.jobs if j.id != id]
+            if removed:
+                self.undefer()
+                updates = self.get_updates()
+        self.report(updates)
+        return len(removed)
+
+    def prune(self):
+        # idle clients below the current share would be raised to it anyway when they return
+        active = [self.usage[j.id] for j in self.jobs if j.id in self.usage]
+        lowest = min(active, default=0)
+        pending = set(j.id for j in self.jobs)
+        for id in list(self.usage.keys()):
+            if not id in pending and self.usage[id] <= lowest:
+                del self.usage[id]
+
+    def needs_swap(self, job, resident):
+        return any(not name in resident.get(comp, []) for comp, name in job.models.items())
+
+    def select(self, jobs, usage, match=None, resident=None, others=[]):
+        candidates = [j for j in jobs if not match or match(j.request)]
+        if not candidates:
+            return None
+
+        # highest priority class first, then jobs that can use the resident models,
+        # leaving jobs that another worker has the models for to that worker,
+        # then the client that has received the least work.
+        # jobs that have waited too long no longer give way to jobs for the resident models
+        now = time.time()
+        def swap(job):
+            if now - job.submitted > self.max_deferral:
+                return 0
+            if resident == None or not self.needs_swap(job, resident):
+                return 0
+            if any(not self.needs_swap(job, r) for r in others):
+                return 2
+            return 1
+        rank = lambda j: (j.deferred, j.priority, swap(j), usage.get(j.id, 0), j.submitted)
+        return min(candidates, key=rank)
+
+    def complete(self, cost, elapsed):
+        # running estimate of seconds per unit of cost, used for the latency budget
+        rate = elapsed / max(cost, 1e-6)
+        with self.lock:
+            self.rate = rate if self.rate == None else 0.8 * self.rate + 0.2 * rate
+            self.undefer()
+
+    def get_backlog(self, priority=None):
+        if self.rate == None:
+            return 0
+        jobs = [j for j in self.jobs if priority == None or j.priority <= priority]
+        return sum(j.cost for j in jobs) * self.rate
+
+    def undefer(self):
+        # once the backlog drains deferred bulk work competes normally again
+        if self.get_backlog() <= self.latency_budget:
+            for job in self.jobs:
+                job.deferred = False
+
+    def get_order(self):
+        # estimated order, the same ranking as select without model affinity since the
+        # resident models are unknown that far ahead. within a class each client is
+        # served oldest first, so only the head job of each client needs comparing
+        classes = collections.defaultdict(lambda: collections.defaultdict(collections.deque))
+        for job in sorted(self.jobs, key=lambda j: j.submitted):
+            classes[(job.deferred, job.priority)][job.id].append(job)
+
+        usage, order = dict(self.usage), []
+        for rank in sorted(classes.keys()):
+            clients = classes[rank]
+            heap = [(usage.get(id, 0), jobs[0].submitted, id) for id, jobs in clients.items()]
+            heapq.heapify(heap)
+            while heap:
+                _, _, id = heapq.heappop(heap)
+                job = clients[id].popleft()
+                usage[id] = usage.get(id, 0) + job.cost
+                order += [job]
+                if clients[id]:
+                    heapq.heappush(heap, (usage[id], clients[id][0].submitted, id))
+        return order
+
+    def get_updates(self):
+        if not self.callback:
+            return []
+        updates = []
+        for position, job in enumerate(self.get_order()):
+            if job.position == position:
+                continue
+            job.position = position
+            updates += [(job, position)]
+        return updates
+
+    def report(self, updates):
+        # sent outside the lock, skipping positions a later report has already replaced
+        for job, position in updates:
+            if job.position != position:
+                continue
+            self.callback(job.id, {"type": "status", "data": {"message": "Queued", "position": position + 1}})
+
+    def __len__(self):
+        with self.lock:
+            return len(self.jobs)
@@ -1,5 +1,8 @@
 import threading
 import queue
+import time
+import functools
+import json
 import torch
 
 import simple_websocket_server as ws_server
@@ -8,26 +11,117 @@ import bson
 import attention
 import storage
 import wrapper
+import scheduler
+import cache
 
 class Inference(threading.Thread):
-    def __init__(self, wrapper, callback):
+    def __init__(self, wrapper, requests, callback, batch_window=0.05, batch_limit=8, prefetch_interval=0.5):
         super().__init__()
         self.wrapper = wrapper
-        wrapper.callback = self.got_response
 
         self.callback = callback
-        self.requests = queue.Queue()
-        self.current = None
+        self.requests = requests
+
+        # how long to hold a txt2img request while looking for others to batch it with
+        self.batch_window = batch_window
+        self.batch_limit = batch_limit
+
+        # clients of the running job, it gets interrupted once all of them have cancelled
+        self.ids = []
+        self.cancelled = set()
+        self.lock = threading.Lock()
+
+        # loads the models of the next job while the current one is running
+        self.prefetch_interval = prefetch_interval
+        self.prefetcher = threading.Thread(target=self.prefetch, daemon=True)
 
         self.stay_alive = True
 
-    def got_response(self, response):
-        return self.callback(self.current, response)
+    def cancel(self, id):
+        with self.lock:
+            if not id in self.ids:
+                return
+            self.cancelled.add(id)
+            if self.cancelled.issuperset(self.ids):
+                self.wrapper.interrupt.set()
+
+    def begin(self, ids):
+        with self.lock:
+            self.ids = ids
+            self.cancelled = set()
+            self.wrapper.interrupt.clear()
+
+    def got_response(self, ids, sizes, response):
+        if sizes and response["type"] == "result":
+            # route each image of the batch to the client it belongs to
+            index = response["data"]["index"]
+            for id, size in zip(ids, sizes):
+                if index < size:
+                    data = dict(response["data"], index=index, total=size)
+                    return self.callback(id, {"type": "result", "data": data})
+                index -= size
+        if sizes and response["type"] == "preview":
+            # split the batched previews back into each clients images
+            images = response["data"]["images"]
+            alive = []
+            for id, size in zip(ids, sizes):
+                data = dict(response["data"], images=images[:size])
+                alive += [self.callback(id, {"type": "preview", "data": data})]
+                images = images[size:]
+            return any(alive)
+        return any([self.callback(id, response) for id in ids])
+
+    def gather(self, id, request):
+        batch = [(id, request)]
+        key = self.wrapper.get_batch_key(request)
+        if not key:
+            return batch
+
+        total = self.wrapper.get_batch_size(request)
+        match = lambda r: self.wrapper.get_batch_key(r) == key and total + self.wrapper.get_batch_size(r) <= self.batch_limit
+
+        deadline = time.time() + self.batch_window
+        while total < self.batch_limit:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                other = self.requests.get(remaining, match)
+            except queue.Empty:
+                break
+            batch.append(other)
+            total += self.wrapper.get_batch_size(other[1])
+
+        return batch
+
+    def prefetch(self):
+        last = None
+        while self.stay_alive:
+            time.sleep(self.prefetch_interval)
+            if not self.ids:
+                continue
+            request = self.requests.peek(resident=self.wrapper.storage.get_resident(), worker=self)
+            if request == None or request is last:
+                continue
+            last = request
+            self.wrapper.storage.prefetch(self.wrapper.get_prefetch(request), self.wrapper.device)
 
     def run(self):
+        self.prefetcher.start()
         while self.stay_alive:
+            ids = []
             try:
-                self.current, request = self.requests.get(True, 0.1)
+                id, request = self.requests.get(0.1, resident=self.wrapper.storage.get_resident(), worker=self)
+                batch = self.gather(id, request)
+                ids, sizes = [id for id, _ in batch], None
+                if len(batch) > 1:
+                    request, sizes = self.wrapper.merge_requests([r for _, r in batch])
+
+                # responses can arrive after the job is over (images are encoded in the background)
+                self.wrapper.callback = functools.partial(self.got_response, ids, sizes)
+                self.begin(ids)
+
+                start = time.time()
                 self.wrapper.reset()
                 if request["type"] == "txt2img":
                     self.wrapper.set(**request["data"])
@@ -35,15 +129,98 @@ class Inference(threading.Thread):
                 elif request["type"] == "img2img":
                     self.wrapper.set(**request["data"])
                     self.wrapper.img2img()
-                self.requests.task_done()
+                self.requests.complete(self.wrapper.get_cost(request), time.time() - start)
             except queue.Empty:
                 pass
             except RuntimeError:
                 pass
             except Exception as e:
-                self.got_response({"type":"error", "data":{"message":str(e)}})
+                self.got_response(ids, None, {"type":"error", "data":{"message":str(e)}})
+            self.begin([])
+
+class ServerBase():
+    # shared by the websocket front ends, owns the workers and the scheduler.
+    # the front ends provide on_response to deliver responses to their clients
+    def __init__(self, wrappers, stats_interval=0):
+        if type(wrappers) != list:
+            wrappers = [wrappers]
+
+        # each worker has its own device and storage, they share one scheduler
+        self.requests = scheduler.Scheduler(wrappers[0].get_cost, wrappers[0].get_models, callback=self.on_response)
+        self.workers = [Inference(w, self.requests, callback=self.on_response) for w in wrappers]
 
-class Server(ws_server.WebSocketServer):
+        self.id = 0
+        self.clients = {}
+
+        # seconds between telemetry log lines, 0 to disable
+        self.stats_interval = stats_interval
+        self.monitor = threading.Thread(target=self.log_stats, daemon=True)
+
+    def start_workers(self):
+        for worker in self.workers:
+            worker.start()
+        if self.stats_interval:
+            self.monitor.start()
+
+    def get_stats(self):
+        stats = {"queued": len(self.requests), "swaps": self.requests.swaps, "swaps_avoided": self.requests.swaps_avoided}
+        caches = {id(w.wrapper.cache): w.wrapper.cache for w in self.workers if w.wrapper.cache}
+        stats["result_cache"] = [{"hits": c.hits, "misses": c.misses} for c in caches.values()]
+        stats["workers"] = [dict(device=str(w.wrapper.device), conditioning=w.wrapper.conditioning_cache.get_stats(), **w.wrapper.storage.get_stats()) for w in self.workers]
+        return stats
+
+    def log_stats(self):
+        while any(w.stay_alive for w in self.workers):
+            time.sleep(self.stats_interval)
+            print("STATS:", json.dumps(self.get_stats()))
+
+    def stop_workers(self):
+        for worker in self.workers:
+            worker.stay_alive = False
+
+    def join_workers(self):
+        for worker in self.workers:
+            worker.join()
+
+    def on_connected(self, connection):
+        self.id += 1
+        self.clients[self.id] = connection
+        print(f"SERVER: client connected")
+        return self.id
+
+    def on_disconnected(self, id):
+        del self.clients[id]
+        self.cancel(id)
+        print(f"SERVER: client disconnected")
+
+    def cancel(self, id):
+        # drop everything the client has queued and stop whatever is running for it
+        self.requests.remove(id)
+        for worker in self.workers:
+            worker.cancel(id)
+
+    def on_reset(self, id):
+        self.cancel(id)
+        self.id += 1
+        self.clients[self.id] = self.clients[id]
+        del self.clients[id]
+        return self.id
+
+    def on_request(self, id, request):
+        if request["type"] == "abort":
+            return self.on_reset(id)
+        if request["type"] == "stats":
+            self.on_response(id, {"type": "stats", "data": self.get_stats()})
+            return id
+
+        # admission estimates cost from the raw request, bad input is reported like a failed job
+        try:
+            self.requests.put(id, request)
+        except Exception as e:
+            self.on_response(id, {"type": "error", "data": {"message": str(e)}})
+        return id
+
+class Server(ServerBase, ws_server.WebSocketServer):
     class Connection(ws_server.WebSocket):
         def connected(self):
             self.id = self.server.on_connected(self)
@@ -73,32 +250,29 @@ class Server(ws_server.WebSocketServer):
             response = {"type": "error", "data": {"message":error}}
             self.send(response)
 
-    def __init__(self, wrapper, host, port):
-        super().__init__(host, port, Server.Connection, select_interval=0.01)
-        self.inference = Inference(wrapper, callback=self.on_response)
+    def __init__(self, wrappers, host, port, stats_interval=0):
+        ws_server.WebSocketServer.__init__(self, host, port, Server.Connection, select_interval=0.01)
+        ServerBase.__init__(self, wrappers, stats_interval)
         self.serve = threading.Thread(target=self.serve_forever)
 
         self.responses = queue.Queue()
 
-        self.id = 0
-        self.clients = {}
-
         self.stay_alive = True
 
     def start(self):
         print("SERVER: starting")
-        self.inference.start()
+        self.start_workers()
         self.serve.start()
 
     def stop(self):
         print("SERVER: stopping")
         self.clients = {}
-        self.inference.stay_alive = False
+        self.stop_workers()
         self.stay_alive = False
         self.join()
 
     def join(self):
-        self.inference.join()
+        self.join_workers()
         self.serve.join()
 
     def serve_forever(self):
@@ -110,40 +284,45 @@ class Server(ws_server.WebSocketServer):
                     self.clients[id].send(response)
         self.close()
 
-    def on_connected(self, connection):
-        self.id += 1
-        self.clients[self.id] = connection
-        print(f"SERVER: client connected")
-        return self.id
-
-    def on_disconnected(self, id):
-        del self.clients[id]
-        print(f"SERVER: client disconnected")
-
-    def on_reset(self, id):
-        self.id += 1
-        self.clients[self.id] = self.clients[id]
-        del self.clients[id]
-        return self.id
-
-    def on_request(self, id, request):
-        if request["type"] == "abort":
-            return self.on_reset(id)
-
-        self.inference.requests.put((id, request))
-        return id
-
     def on_response(self, id, response):
         self.responses.put((id, response))
         return id in self.clients
 
 if __name__ == "__main__":
+    import argparse
+    DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16, "fp32": torch.float32}
+    parser = argparse.ArgumentParser(description='Inference server')
+    parser.add_argument('--host', type=str, default="127.0.0.1", help='address to listen on')
+    parser.add_argument('--port', type=str, default="28888", help='port to listen on')
+    parser.add_argument('--devices', type=str, nargs='+', default=["cuda"], help='devices to run workers on, one worker per device')
+    parser.add_argument('--asyncio', action='store_true', help='use the asyncio front end')
+    parser.add_argument('--vram-budget', type=float, default=8, help='GiB of models to keep on each device')
+    parser.add_argument('--ram-budget', type=float, default=16, help='GiB of models to keep in system memory per worker')
+    parser.add_argument('--dtype', type=str, default="fp16", choices=DTYPES.keys(), help='dtype of the models on gpu devices')
+    parser.add_argument('--vae-dtype', type=str, default="fp32", choices=DTYPES.keys(), help='dtype of the VAE on gpu devices')
+    parser.add_argument('--stats-interval', type=float, default=60, help='seconds between telemetry log lines, 0 to disable')
+    parser.add_argument('--cache', type=str, default="./cache", help='folder to cache results in, empty to disable')
+    args = parser.parse_args()
+
     attention.use_optimized_attention()
 
-    model_storage = storage.ModelStorage("./models", torch.float16, torch.float32)
-    params = wrapper.GenerationParameters(model_storage, torch.device("cuda"))
+    result_cache = cache.ResultCache(args.cache) if args.cache else None
+
+    wrappers = []
+    for device in args.devices:
+        device = torch.device(device)
+        budgets = dict(vram_budget=int(args.vram_budget * 2**30), ram_budget=int(args.ram_budget * 2**30))
+        if device.type == "cpu":
+            model_storage = storage.ModelStorage("./models", torch.float32, torch.float32, **budgets)
+        else:
+            model_storage = storage.ModelStorage("./models", DTYPES[args.dtype], DTYPES[args.vae_dtype], **budgets)
+        wrappers += [wrapper.GenerationParameters(model_storage, device, cache=result_cache)]
 
-    server = Server(params, "127.0.0.1", "28888")
+    if args.asyncio:
+        from async_server import AsyncServer
+        server = AsyncServer(wrappers, args.host, args.port, stats_interval=args.stats_interval)
+    else:
+        server = Server(wrappers, args.host, args.port, stats_interval=args.stats_interval)
     server.start()
     
     try:
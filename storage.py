@@ -1,79 +1,524 @@
 import torch
 import os
 import glob
+import time
+import itertools
+import threading
+import collections
+import json
+import struct
+import hashlib
+import concurrent.futures
+import safetensors
 import safetensors.torch
 
 import models
 import upscalers
 
+SAFETENSORS_DTYPES = {"F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16}
+
+def read_safetensors_header(file):
+    with open(file, "rb") as f:
+        length = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(length))
+    header.pop("__metadata__", None)
+    return header, 8 + length
+
+class LazyModel():
+    # memory maps the file and indexes it by component, tensors are only read when a component is asked for
+    def __init__(self, file, comp, dtypes):
+        self.file = file
+        self.dtypes = dtypes
+        self.header, self.offset = read_safetensors_header(file)
+        self.handle = safetensors.safe_open(file, framework="pt")
+
+        self.metadata = {}
+        self.components = {}
+
+        # components read while hashing, handed over on the next read instead of reading them again
+        self.read_components = {}
+
+        if not "metadata.model_type" in self.header:
+            self.components[comp] = {k: k for k in self.header}
+            return
+
+        for k in self.header:
+            if k.startswith("metadata."):
+                kk = k.split(".", 1)[1]
+                self.metadata[kk] = ''.join([chr(c) for c in self.handle.get_tensor(k)])
+
+        model_type = self.metadata["model_type"]
+        for k in self.header:
+            if k.startswith("metadata."):
+                continue
+            c = k.split(".")[1]
+            if not c in self.components:
+                self.components[c] = {}
+            self.components[c][k[len(f"{model_type}.{c}."):]] = k
+
+    def __contains__(self, comp):
+        return comp in self.components
+
+    def get_size(self, comp, cast=True):
+        # bytes the component takes once cast to its runtime dtype, or as stored
+        size = 0
+        for k in self.components[comp].values():
+            info = self.header[k]
+            begin, end = info["data_offsets"]
+            dtype = SAFETENSORS_DTYPES.get(info["dtype"])
+            if cast and dtype and self.dtypes.get(comp):
+                end = begin + (end - begin) * torch.finfo(self.dtypes[comp]).bits // torch.finfo(dtype).bits
+            size += end - begin
+        return size
+
+    def get_hash(self, comp):
+        # hash of the stored tensors, identical weights in different files hash the same.
+        # the component is read at the same time and kept for the load that follows
+        state_dict, hash = self.read(comp, hashlib.sha256())
+        self.read_components[comp] = state_dict
+        return hash.hexdigest()
+
+    def __getitem__(self, comp):
+        if comp in self.read_components:
+            return self.read_components.pop(comp)
+        return self.read(comp)[0]
+
+    def read(self, comp, hash=None):
+        dtype = self.dtypes.get(comp)
+        state_dict = {}
+
+        # hashing runs alongside the casts, both release the GIL
+        def update(info, tensor):
+            hash.update(json.dumps(info, sort_keys=True).encode())
+            if tensor != None:
+                hash.update(tensor.contiguous().reshape(-1).view(torch.uint8).numpy())
+        hasher, updates = concurrent.futures.ThreadPoolExecutor(1), []
+        if hash:
+            metadata = self.metadata if comp == "UNET" else self.metadata.get("model_type")
+            updates += [hasher.submit(update, [comp, metadata], None)]
+
+        for key, k in sorted(self.components[comp].items()):
+            tensor = self.handle.get_tensor(k)
+            if hash:
+                info = self.header[k]
+                updates += [hasher.submit(update, [key, info["dtype"], info["shape"]], tensor)]
+            if dtype and tensor.dtype in SAFETENSORS_DTYPES.values():
+                tensor = tensor.to(dtype)
+            state_dict[key] = tensor
+
+        hasher.shutdown(wait=True)
+        for future in updates:
+            future.result()
+
+        if self.metadata:
+            source_dtype = None
+            for k in self.components[comp].values():
+                source_dtype = source_dtype or SAFETENSORS_DTYPES.get(self.header[k]["dtype"])
+            state_dict['metadata'] = self.metadata.copy()
+            state_dict['metadata']["dtype"] = source_dtype
+        return state_dict, hash
+
+class FileIndex():
+    # persisted listing of model files, entries are kept while the files mtime and size are unchanged
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.folders = {}
+        self.changed = False
+
+        try:
+            with open(self.path, "r") as f:
+                index = json.load(f)
+            self.entries = index["entries"]
+            self.folders = index["folders"]
+        except Exception:
+            pass
+
+    def list(self, root, folder, pattern):
+        # a folders listing only changes when its mtime does, recent mtimes may hide changes made in the same tick
+        try:
+            mtime = os.stat(os.path.join(root, folder)).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        key = os.path.join(folder, pattern)
+        if key in self.folders and self.folders[key][0] == mtime:
+            return self.folders[key][1]
+        files = sorted(os.path.relpath(f, root) for f in glob.glob(os.path.join(root, key)))
+        if time.time_ns() - mtime > 2e9:
+            self.folders[key] = [mtime, files]
+            self.changed = True
+        return files
+
+    def get(self, root, file):
+        # the files entry, reset if the file has changed since it was recorded
+        stat = os.stat(os.path.join(root, file))
+        entry = self.entries.get(file)
+        if not entry or entry["mtime"] != stat.st_mtime_ns or entry["size"] != stat.st_size:
+            entry = {"mtime": stat.st_mtime_ns, "size": stat.st_size}
+            self.entries[file] = entry
+            self.changed = True
+        return entry
+
+    def prune(self, files):
+        for file in list(self.entries.keys()):
+            if not file in files:
+                del self.entries[file]
+                self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        tmp = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump({"entries": self.entries, "folders": self.folders}, f)
+            os.replace(tmp, self.path)
+            self.changed = False
+        except OSError:
+            pass
+
+def same_device(a, b):
+    a, b = torch.device(a), torch.device(b)
+    return a.type == b.type and (a.index == b.index or a.index == None or b.index == None)
+
+def get_tensors(model):
+    return list(itertools.chain(model.parameters(), model.buffers()))
+
+def get_size(model):
+    return sum(t.numel() * t.element_size() for t in get_tensors(model))
+
+def pin_tensors(model):
+    buffers = []
+    for tensor in get_tensors(model):
+        tensor.data = tensor.data.pin_memory()
+        buffers += [tensor.data]
+    return buffers
+
 class ModelStorage():
-    def __init__(self, path, dtype, vae_dtype=None):
+    def __init__(self, path, dtype, vae_dtype=None, vram_budget=2**33, ram_budget=2**34):
         self.path = path
         self.dtype = dtype
         self.vae_dtype = vae_dtype or dtype
 
         self.classes = {"UNET": models.UNET, "CLIP": models.CLIP, "VAE": models.VAE, "SR": upscalers.SR, "LoRA": models.LoRA, "HN": models.HN}
-        self.vram_limits = {"UNET": 1, "CLIP": 1, "VAE": 1, "SR": 1}
-        self.total_limits = {"UNET": 1, "CLIP": 1, "VAE": 1, "SR": 1}
+
+        # bytes of loaded models allowed on the device and in system memory
+        self.vram_budget = vram_budget
+        self.ram_budget = ram_budget
+
+        # a second of reload time counts as this many seconds of recent use when picking what to evict
+        self.cost_weight = 60
 
         self.files = {k:{} for k in self.classes}
         self.loaded = {k:{} for k in self.classes}
         self.file_cache = {}
 
-        self.embeddings = {}
-
+        # models can be loaded from a prefetch thread while the inference thread is using them
+        self.lock = threading.RLock()
+
+        self.sizes = {}
+        self.load_times = {}
+        # components being read from disk, the lock isnt held while reading
+        self.loading = {}
+        # converted components are written to the cache off the loading thread
+        self.writer = concurrent.futures.ThreadPoolExecutor(1)
+        self.last_used = {}
+        self.in_use = set()
+
+        # pinned system memory copies of models, kept while the model is on the device so
+        # offloading is free (weights are never modified in place) and onloading can be async
+        self.pinned = {}
+        self.streams = {}
+        self.freed = False
+
+        # counters for telemetry per component, loads from the source files are cold, from the converted
+        # cache are converted, and from system memory to the device are warm
+        self.stats = {comp: {
+            "hits": 0, "misses": 0, "prefetches": 0,
+            "cold_loads": 0, "cold_seconds": 0.0, "converted_loads": 0, "converted_seconds": 0.0,
+            "warm_loads": 0, "warm_seconds": 0.0, "disk_bytes": 0,
+            "host_to_device_bytes": 0, "device_to_host_bytes": 0,
+            "device_evictions": 0, "memory_evictions": 0
+        } for comp in self.classes}
+
+        # timing events of host to device copies, read once the copies have finished
+        self.transfers = []
+
+        # embeddings are indexed by name, the vectors are loaded when a prompt uses them
+        self.embedding_files = {}
+        self.embeddings = collections.OrderedDict()
+        self.embedding_limit = 64
+
+        self.index = FileIndex(os.path.join(self.path, "index.json"))
         self.find_all()
 
     def clear_file_cache(self):
         self.file_cache = {}
 
-    def enforce_vram_limit(self, allowed, comp, limit):
-        found = 0
-        for m in self.loaded[comp]:
-            if m == allowed:
-                continue
-            if str(self.loaded[comp][m].device) != "cpu":
-                if found >= limit:
-                    self.loaded[comp][m].to("cpu")
+    def clear_in_use(self):
+        self.in_use = set()
+        self.flush()
+
+    def flush(self):
+        # returning freed memory to the driver is slow, so its done once per job
+        if self.freed:
+            torch.cuda.empty_cache()
+            self.freed = False
+        self.collect_transfers()
+
+    def collect_transfers(self):
+        with self.lock:
+            pending = []
+            for comp, begin, end in self.transfers:
+                if end.query():
+                    self.stats[comp]["warm_seconds"] += begin.elapsed_time(end) / 1000
                 else:
-                    found += 1
-        torch.cuda.empty_cache()
-
-    def enforce_total_limit(self, allowed, comp, limit):
-        found = 0
-        for m in list(self.loaded[comp].keys()):
-            if m == allowed:
-                continue
-            if found >= limit:
-                self.loaded[comp][m].to("cpu")
-                del self.loaded[comp][m]
-            else:
-                found += 1
-        torch.cuda.empty_cache()
+                    pending += [(comp, begin, end)]
+            self.transfers = pending
+
+    def get_usage(self):
+        vram, ram = 0, 0
+        for comp in self.loaded:
+            for name, model in list(self.loaded[comp].items()):
+                if str(model.device) == "cpu":
+                    ram += self.sizes[(comp, name)]
+                else:
+                    vram += self.sizes[(comp, name)]
+                    if (comp, name) in self.pinned:
+                        ram += self.sizes[(comp, name)]
+        return vram, ram
+
+    def get_eviction_score(self, comp, name, on_device):
+        # LRU weighted by how long it takes to get the model back
+        size = self.sizes[(comp, name)]
+        if on_device:
+            cost = size / 2**34 # roughly a host to device copy
+        elif str(self.loaded[comp][name].device) != "cpu":
+            cost = 0 # only the pinned copy, the model stays on the device
+        else:
+            cost = self.load_times[(comp, name)]
+        return self.last_used[(comp, name)] + cost * self.cost_weight
+
+    def get_eviction_candidate(self, on_device):
+        candidates = []
+        for comp in self.loaded:
+            for name, model in self.loaded[comp].items():
+                if (comp, name) in self.in_use:
+                    continue
+                if on_device and str(model.device) == "cpu":
+                    continue
+                if not on_device and str(model.device) != "cpu" and not (comp, name) in self.pinned:
+                    continue
+                candidates += [(self.get_eviction_score(comp, name, on_device), comp, name)]
+        if not candidates:
+            return None
+        return min(candidates)[1:]
+
+    def enforce_budgets(self, vram_needed=0, ram_needed=0):
+        # models decay from gpu -> cpu -> disk, cheapest to get back first
+        while True:
+            vram, ram = self.get_usage()
+            if vram + vram_needed <= self.vram_budget:
+                break
+            candidate = self.get_eviction_candidate(True)
+            if not candidate:
+                break
+            comp, name = candidate
+            self.offload(comp, name)
+            self.stats[comp]["device_evictions"] += 1
+
+        while True:
+            vram, ram = self.get_usage()
+            if ram + ram_needed <= self.ram_budget:
+                break
+            candidate = self.get_eviction_candidate(False)
+            if not candidate:
+                break
+            comp, name = candidate
+            if str(self.loaded[comp][name].device) == "cpu":
+                del self.loaded[comp][name]
+            self.pinned.pop((comp, name), None)
+            self.stats[comp]["memory_evictions"] += 1
+
+    def get_stream(self, device):
+        device = torch.device(device)
+        if device.index == None:
+            device = torch.device(device.type, torch.cuda.current_device())
+        if not device in self.streams:
+            self.streams[device] = torch.cuda.Stream(device)
+        return self.streams[device]
+
+    def pin(self, comp, name):
+        model = self.loaded[comp][name]
+        if (comp, name) in self.pinned or str(model.device) != "cpu" or not torch.cuda.is_available():
+            return
+        self.pinned[(comp, name)] = pin_tensors(model)
+
+    def offload(self, comp, name):
+        model = self.loaded[comp][name]
+        if model.device.type != "cuda":
+            self.loaded[comp][name] = model.to("cpu")
+            return
+
+        tensors = get_tensors(model)
+        if not (comp, name) in self.pinned:
+            stream = self.get_stream(model.device)
+            stream.wait_stream(torch.cuda.current_stream(model.device))
+            buffers = [torch.empty(t.shape, dtype=t.dtype, pin_memory=True) for t in tensors]
+            with torch.cuda.stream(stream):
+                for tensor, buffer in zip(tensors, buffers):
+                    buffer.copy_(tensor.data, non_blocking=True)
+                    tensor.data.record_stream(stream)
+            # the buffers become the models cpu tensors, they cant be read before the copies land
+            stream.record_event().synchronize()
+            self.pinned[(comp, name)] = buffers
+            self.stats[comp]["device_to_host_bytes"] += self.sizes[(comp, name)]
+
+        for tensor, buffer in zip(tensors, self.pinned[(comp, name)]):
+            tensor.data = buffer
+        self.freed = True
+
+    def onload(self, comp, name, device):
+        model = self.loaded[comp][name]
+        if torch.device(device).type != "cuda":
+            return model.to(device)
+
+        self.pin(comp, name)
+        stream = self.get_stream(device)
+        current = torch.cuda.current_stream(device)
+        begin, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+        with torch.cuda.stream(stream):
+            begin.record(stream)
+            for tensor, buffer in zip(get_tensors(model), self.pinned[(comp, name)]):
+                tensor.data = buffer.to(device, non_blocking=True)
+                tensor.data.record_stream(current)
+            end.record(stream)
+        # the compute stream waits for the copies, the host doesnt
+        current.wait_stream(stream)
+
+        self.transfers += [(comp, begin, end)]
+        self.stats[comp]["warm_loads"] += 1
+        self.stats[comp]["host_to_device_bytes"] += self.sizes[(comp, name)]
+        return model
 
     def enforce_network_limit(self, used, comp):
         # networks cant have a hard limit since you can use an arbitrary number of them
         # so they are "decayed" from gpu -> cpu -> disk as they are left unused
-        for m in list(self.loaded[comp].keys()):
-            if m in used:
-                continue
-            if str(self.loaded[comp][m].device) != "cpu":
-                self.loaded[comp][m].to("cpu")
-            else:
-                del self.loaded[comp][m]
+        with self.lock:
+            for m in list(self.loaded[comp].keys()):
+                if m in used or (comp, m) in self.in_use:
+                    continue
+                if str(self.loaded[comp][m].device) != "cpu":
+                    self.offload(comp, m)
+                else:
+                    del self.loaded[comp][m]
+                    self.pinned.pop((comp, m), None)
 
     def move(self, model, name, comp, device):
-        if model.device == device:
+        self.in_use.add((comp, name))
+        self.last_used[(comp, name)] = time.time()
+
+        if same_device(model.device, device):
             return model
 
-        if comp in self.total_limits:
-            if str(device) == "cpu":
-                self.enforce_total_limit(name, comp, self.total_limits[comp]-1)
-            else:
-                self.enforce_vram_limit(name, comp, self.vram_limits[comp]-1)
-                self.enforce_total_limit(name, comp, self.total_limits[comp]-1)
-        
-        return model.to(device)
+        size = self.sizes[(comp, name)]
+        if str(device) == "cpu":
+            self.offload(comp, name)
+            self.enforce_budgets()
+            return self.loaded[comp][name]
+
+        # the system memory copy is kept when moving to a cuda device
+        self.enforce_budgets(vram_needed=size, ram_needed=0 if torch.device(device).type == "cuda" else -size)
+        return self.onload(comp, name, device)
+
+    def get_stats(self):
+        # read without the lock so its never stuck behind a load, the numbers may be a moment out of date.
+        # copy times are added as jobs finish
+        components = {}
+        for comp in self.classes:
+            stats = dict(self.stats[comp])
+            stats["loaded"], stats["device_bytes"], stats["memory_bytes"], stats["pinned_bytes"] = 0, 0, 0, 0
+            for name, model in list(self.loaded[comp].items()):
+                size = self.sizes.get((comp, name), 0)
+                stats["loaded"] += 1
+                if str(model.device) == "cpu":
+                    stats["memory_bytes"] += size
+                else:
+                    stats["device_bytes"] += size
+                if (comp, name) in self.pinned:
+                    stats["pinned_bytes"] += size
+                    if str(model.device) != "cpu":
+                        stats["memory_bytes"] += size
+            components[comp] = stats
+
+        stats = {}
+        stats["device_bytes"], stats["memory_bytes"] = self.get_usage()
+        stats["pinned_bytes"] = sum(c["pinned_bytes"] for c in components.values())
+        stats["device_budget"], stats["memory_budget"] = self.vram_budget, self.ram_budget
+        stats["components"] = components
+        return stats
+
+    def get_resident(self):
+        with self.lock:
+            resident = {}
+            for comp in ["UNET", "CLIP", "VAE"]:
+                resident[comp] = [n for n in self.files[comp] if self.get_known_key(n, comp) in self.loaded[comp]]
+            return resident
+
+    def get_known_key(self, name, comp):
+        file = self.files[comp][name]
+        if not comp in {"UNET", "CLIP", "VAE"} or not file.endswith(".st"):
+            return name
+        return self.index.entries.get(file, {}).get("hashes", {}).get(comp)
+
+    def get_key(self, name, comp, files=None):
+        # UNET/CLIP/VAE are keyed by their content so identical weights are only loaded once
+        with self.lock:
+            if not name in self.files[comp]:
+                raise ValueError(f"ERROR unknown {comp}: {name}")
+            file = self.files[comp][name]
+            if not comp in {"UNET", "CLIP", "VAE"} or not file.endswith(".st"):
+                return name
+
+            # hashes are stored in the index so they are computed once per file
+            entry = self.index.get(self.path, file)
+            hashes = entry.setdefault("hashes", {})
+            if comp in hashes:
+                return hashes[comp]
+
+        # hashing reads the whole component, which is kept for loading it.
+        # other threads can use the storage meanwhile
+        files = self.file_cache if files == None else files
+        if not file in files:
+            files[file] = self.load_file(file, comp)
+        if not comp in files[file]:
+            raise ValueError(f"ERROR model doesnt contain a {comp}: {name}")
+        with self.lock:
+            self.enforce_budgets(ram_needed=files[file].get_size(comp))
+        hash = files[file].get_hash(comp)
+
+        with self.lock:
+            hashes[comp] = hash
+            self.index.changed = True
+            self.index.save()
+        return hash
+
+    def get_identity(self, name, comp):
+        if not name in self.files[comp]:
+            return None
+        file = self.files[comp][name]
+        stat = os.stat(os.path.join(self.path, file))
+        return [file, stat.st_mtime, stat.st_size]
+
+    def get_embedding_identities(self, text):
+        # only embeddings that could appear in the text matter
+        text = text.lower()
+        identities = {}
+        for name, file in self.embedding_files.items():
+            if name.lower() in text:
+                stat = os.stat(os.path.join(self.path, file))
+                identities[name] = [file, stat.st_mtime, stat.st_size]
+        return identities
 
     def get_name(self, file):
         file = file.split(".")[0]
@@ -81,68 +526,174 @@ class ModelStorage():
         return file
 
     def find_all(self):
-        self.files = {k:{} for k in self.classes}
-        for model in glob.glob(os.path.join(self.path, "SD", "*.st")):
-            file = os.path.relpath(model, self.path)
-
-            if ".unet." in file:
-                name = self.get_name(file)
-                self.files["UNET"][name] = file
-            elif ".clip." in file:
+        with self.lock:
+            self.files = {k:{} for k in self.classes}
+            for file in self.index.list(self.path, "SD", "*.st"):
                 name = self.get_name(file)
-                self.files["CLIP"][name] = file
-            elif ".vae." in file:
-                name = self.get_name(file)
-                self.files["VAE"][name] = file
-            else:
-                name = self.get_name(file)
-                self.files["UNET"][name] = file
-                self.files["CLIP"][name] = file
-                self.files["VAE"][name] = file
+                if ".unet." in file:
+                    self.files["UNET"][name] = file
+                elif ".clip." in file:
+                    self.files["CLIP"][name] = file
+                elif ".vae." in file:
+                    self.files["VAE"][name] = file
+                else:
+                    self.files["UNET"][name] = file
+                    self.files["CLIP"][name] = file
+                    self.files["VAE"][name] = file
         
-        for model in glob.glob(os.path.join(self.path, "SR", "*.pth")):
-            file = os.path.relpath(model, self.path)
-            name = self.get_name(file)
-            self.files["SR"][name] = file
-
-        self.embeddings = {}
-        for model in glob.glob(os.path.join(self.path, "TI", "*.pt")):
-            file = os.path.relpath(model, self.path)
-            name = self.get_name(file)
-            vectors = torch.load(model)["string_to_param"]["*"]
-            vectors.requires_grad = False
-            self.embeddings[name] = vectors
+            for file in self.index.list(self.path, "SR", "*.pth"):
+                self.files["SR"][self.get_name(file)] = file
 
-        for model in glob.glob(os.path.join(self.path, "LoRA", "*.safetensors")):
-            file = os.path.relpath(model, self.path)
-            name = self.get_name(file)
-            self.files["LoRA"][name] = file
+            for file in self.index.list(self.path, "LoRA", "*.safetensors"):
+                self.files["LoRA"][self.get_name(file)] = file
 
-        for model in glob.glob(os.path.join(self.path, "HN", "*.pt")):
-            file = os.path.relpath(model, self.path)
-            name = self.get_name(file)
-            self.files["HN"][name] = file
+            for file in self.index.list(self.path, "HN", "*.pt"):
+                self.files["HN"][self.get_name(file)] = file
+
+            self.embedding_files = {}
+            for file in self.index.list(self.path, "TI", "*.pt"):
+                self.embedding_files[self.get_name(file)] = file
+            for name in list(self.embeddings.keys()):
+                if not name in self.embedding_files:
+                    del self.embeddings[name]
+
+            self.index.prune(set(self.embedding_files.values()) | set(f for c in self.files.values() for f in c.values()))
+            self.index.save()
 
     def get_component(self, name, comp, device):
-        if name in self.loaded[comp]:
-            return self.move(self.loaded[comp][name], name, comp, device)
-        
-        if not name in self.files[comp]:
-            raise ValueError(f"ERROR unknown {comp}: {name}")
-        
+        key = self.get_key(name, comp)
+        missed = False
+        while True:
+            with self.lock:
+                if key in self.loaded[comp]:
+                    if not missed:
+                        self.stats[comp]["hits"] += 1
+                    return self.move(self.loaded[comp][key], key, comp, device)
+                loading = self.loading.get((comp, key))
+                if not loading:
+                    self.loading[(comp, key)] = threading.Event()
+
+            # another thread is already reading it
+            if loading:
+                loading.wait()
+                continue
+
+            with self.lock:
+                self.stats[comp]["misses"] += 1
+            missed = True
+            self.load_component(key, name, comp, self.file_cache)
+
+    def load_component(self, key, name, comp, files, pin=False):
+        # the caller marks the component as loading, only registering it needs the lock
+        try:
+            start = time.time()
+            model, source, disk_bytes = self.read_component(key, name, comp, files)
+            buffers = pin_tensors(model) if pin else None
+            elapsed = time.time() - start
+
+            with self.lock:
+                self.stats[comp][f"{source}_loads"] += 1
+                self.stats[comp][f"{source}_seconds"] += elapsed
+                self.stats[comp]["disk_bytes"] += disk_bytes
+
+                self.sizes[(comp, key)] = get_size(model)
+                self.load_times[(comp, key)] = elapsed
+                self.last_used[(comp, key)] = time.time()
+                self.loaded[comp][key] = model
+                if buffers:
+                    self.pinned[(comp, key)] = buffers
+
+                # make room in system memory for the new model
+                self.in_use.add((comp, key))
+                self.enforce_budgets()
+        finally:
+            with self.lock:
+                self.loading.pop((comp, key)).set()
+
+    def read_component(self, key, name, comp, files):
         file = self.files[comp][name]
-        
-        if not file in self.file_cache:
-            self.file_cache[file] = self.load_file(file, comp)
 
-        if comp in self.file_cache[file]:
-            dtype = self.vae_dtype if comp == "VAE" else self.dtype
-            model = self.classes[comp].from_model(self.file_cache[file][comp], dtype)
+        # a component already read while hashing it is used as is
+        read = type(files.get(file)) == LazyModel and comp in files[file].read_components
+
+        # make room in system memory before loading rather than after
+        converted = self.get_converted_file(key, name, comp)
+        if converted and os.path.exists(converted) and not read:
+            with self.lock:
+                self.enforce_budgets(ram_needed=os.path.getsize(converted))
+            model = self.classes[comp].from_model(self.load_converted(converted), self.get_dtype(comp))
+            return model, "converted", os.path.getsize(converted)
+
+        if not file in files:
+            files[file] = self.load_file(file, comp)
+
+        if comp in files[file]:
+            if type(files[file]) == LazyModel and not read:
+                with self.lock:
+                    self.enforce_budgets(ram_needed=files[file].get_size(comp))
+            model = self.classes[comp].from_model(files[file][comp], self.get_dtype(comp))
         else:
             raise ValueError(f"ERROR model doesnt contain a {comp}: {name}")
 
-        self.loaded[comp][name] = model
-        return self.move(model, name, comp, device)
+        if type(files[file]) == LazyModel:
+            disk_bytes = files[file].get_size(comp, cast=False)
+        else:
+            disk_bytes = os.path.getsize(os.path.join(self.path, file))
+
+        if converted and not os.path.exists(converted):
+            self.save_converted(model, converted)
+        return model, "cold", disk_bytes
+
+    def get_converted_file(self, key, name, comp):
+        # components are cached in the runtime dtype and layout, keyed by the source hash
+        if key == name:
+            return None
+        dtype = str(self.get_dtype(comp)).split(".")[-1]
+        return os.path.join(self.path, "cache", f"{key}.{comp}.{dtype}.safetensors")
+
+    def load_converted(self, file):
+        print(f"LOADING {os.path.relpath(file, self.path)}...")
+        with safetensors.safe_open(file, framework="pt") as f:
+            metadata = f.metadata()
+        state_dict = safetensors.torch.load_file(file)
+        state_dict['metadata'] = metadata
+        return state_dict
+
+    def save_converted(self, model, file):
+        # written in the background, the tensors are held until then even if the model moves
+        metadata = {"model_type": model.model_type}
+        if hasattr(model, "prediction_type"):
+            metadata["prediction_type"] = model.prediction_type
+        state_dict = {k: v.contiguous() for k, v in model.state_dict().items()}
+        self.writer.submit(self.write_converted, state_dict, metadata, file)
+
+    def write_converted(self, state_dict, metadata, file):
+        tmp = f"{file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+            safetensors.torch.save_file(state_dict, tmp, metadata=metadata)
+            os.replace(tmp, file)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def prefetch(self, models, device):
+        # load models into system memory ahead of time, they are moved to the device when used.
+        # the lock is only taken to register them, so the inference thread isnt held up
+        files = {}
+        for comp, names in models.items():
+            for name in names:
+                try:
+                    key = self.get_key(name, comp, files)
+                    with self.lock:
+                        if key in self.loaded[comp] or (comp, key) in self.loading:
+                            continue
+                        self.loading[(comp, key)] = threading.Event()
+                    self.load_component(key, name, comp, files, pin=torch.device(device).type == "cuda" and torch.cuda.is_available())
+                    with self.lock:
+                        self.stats[comp]["prefetches"] += 1
+                except Exception:
+                    pass
 
     def get_unet(self, name, device):
         unet = self.get_component(name, "UNET", device)
@@ -150,7 +701,6 @@ class ModelStorage():
 
     def get_clip(self, name, device):
         clip = self.get_component(name, "CLIP", device)
-        clip.textual_inversions = {}
         return clip
 
     def get_vae(self, name, device):
@@ -159,10 +709,32 @@ class ModelStorage():
     def get_upscaler(self, name, device):
         return self.get_component(name, "SR", device)
 
-    def get_embeddings(self, device):
-        for k in self.embeddings:
-            self.embeddings[k] = self.embeddings[k].to(device)
-        return self.embeddings
+    def get_embedding_names(self):
+        return list(self.embedding_files.keys())
+
+    def get_embedding(self, name, device):
+        with self.lock:
+            if not name in self.embedding_files:
+                raise ValueError(f"ERROR unknown embedding: {name}")
+            file = self.embedding_files[name]
+
+            # loaded vectors are kept until their file changes or they fall out of the LRU
+            entry = self.index.get(self.path, file)
+            if name in self.embeddings:
+                loaded, vectors = self.embeddings[name]
+                if loaded is entry and same_device(vectors.device, device):
+                    self.embeddings.move_to_end(name)
+                    return vectors
+
+            vectors = torch.load(os.path.join(self.path, file), map_location="cpu")["string_to_param"]["*"]
+            vectors.requires_grad = False
+            vectors = vectors.to(device)
+
+            self.embeddings[name] = (entry, vectors)
+            self.embeddings.move_to_end(name)
+            while len(self.embeddings) > self.embedding_limit:
+                self.embeddings.popitem(last=False)
+            return vectors
 
     def get_lora(self, name, device):
         return self.get_component(name, "LoRA", device)
@@ -170,47 +742,14 @@ class ModelStorage():
     def get_hypernetwork(self, name, device):
         return self.get_component(name, "HN", device)
 
+    def get_dtype(self, comp):
+        return self.vae_dtype if comp == "VAE" else self.dtype
+
     def load_file(self, file, comp):
         print(f"LOADING {file}...")
         file = os.path.join(self.path, file)
 
         if file.endswith(".st") or file.endswith(".safetensors"):
-            state_dict = safetensors.torch.load_file(file)
-            if "metadata.model_type" in state_dict:
-                return self.parse_model(state_dict)
-            else:
-                return {comp: state_dict}
+            return LazyModel(file, comp, {c: self.get_dtype(c) for c in self.classes})
         else:
             return {comp: torch.load(file)}
-
-    def parse_model(self, state_dict):
-        metadata = {}
-        for k in state_dict:
-            if k.startswith("metadata."):
-                kk = k.split(".", 1)[1]
-                metadata[kk] = ''.join([chr(c) for c in state_dict[k]])
-
-        model_type = metadata["model_type"]
-
-        sub_state_dicts = {}
-        for k in list(state_dict.keys()):
-            if k.startswith("metadata."):
-                continue
-            comp = k.split(".")[1]
-            key = k[len(f"{model_type}.{comp}."):]
-            if not comp in sub_state_dicts:
-                sub_state_dicts[comp] = {}
-            sub_state_dicts[comp][key] = state_dict[k]
-            del state_dict[k]
-
-        for m in sub_state_dicts:
-            dtype = None
-            for k in sub_state_dicts[m]:
-                t = sub_state_dicts[m][k]
-                if type(t) == torch.Tensor and t.dtype in [torch.float16, torch.float32]:
-                    dtype = t.dtype
-                    break
-            metadata["dtype"] = dtype
-            sub_state_dicts[m]['metadata'] = metadata.copy()
-        
-        return sub_state_dicts
\ No newline at end of file
@@ -1,6 +1,7 @@
 import torch
 import PIL.Image
 import io
+import sys
 import bson
 
 import websocket as ws_client
@@ -9,14 +10,26 @@ import bson
 import attention
 import storage
 import wrapper
+import cache
 from server import Server
 
 attention.use_optimized_attention()
 
-model_storage = storage.ModelStorage("./models", torch.float16, torch.float32)
-params = wrapper.GenerationParameters(model_storage, torch.device("cuda"))
+# one worker per device given, e.g. "python test.py cpu cpu"
+devices = [torch.device(d) for d in sys.argv[1:] or ["cuda"]]
+on_cpu = all(d.type == "cpu" for d in devices)
 
-server = Server(params, "127.0.0.1", "28888")
+result_cache = cache.ResultCache("./cache")
+wrappers = []
+for device in devices:
+    if device.type == "cpu":
+        # bf16 so a few cpu workers each holding the models fit in memory
+        model_storage = storage.ModelStorage("./models", torch.bfloat16, torch.bfloat16)
+    else:
+        model_storage = storage.ModelStorage("./models", torch.float16, torch.float32)
+    wrappers += [wrapper.GenerationParameters(model_storage, device, cache=result_cache)]
+
+server = Server(wrappers, "127.0.0.1", "28888")
 server.start()
 
 client = ws_client.WebSocket()
@@ -29,20 +42,53 @@ request = {"type":"txt2img", "data": {
     "hr_factor":2.0, "hr_strength":0.7, "hr_steps":20
 }}
 
-client.send_binary(bson.dumps(request))
+if on_cpu:
+    request["data"].update(width=64, height=64, steps=2)
+    for k in ["hr_factor", "hr_strength", "hr_steps"]:
+        del request["data"][k]
+
+def run(request, client=client):
+    if request:
+        client.send_binary(bson.dumps(request))
+
+    image = None
+
+    while not image:
+        response = client.recv()
+        response = bson.loads(response)
+        
+        assert response["type"] != "error", response
+        if response["type"] == "result":
+            for i, image_data in enumerate(response["data"]["images"]):
+                image = PIL.Image.open(io.BytesIO(image_data))
+            response["data"] = "..."
+        print(response)
+
+    return image
 
-image = None
+try:
+    # the second run is served from the result cache, without a format given
+    image = run(request)
+    cached = run(request)
+    assert cached.tobytes() == image.tobytes()
 
-while not image:
-    response = client.recv()
-    response = bson.loads(response)
-    
-    if response["type"] == "result":
-        for i, image_data in enumerate(response["data"]["images"]):
-            image = PIL.Image.open(io.BytesIO(image_data))
-        response["data"] = "..."
-    print(response)
+    # one job per worker at once, random seeds so the result cache cant answer them
+    # and sizes that differ so they arent batched together
+    if len(devices) > 1:
+        clients = []
+        for i in range(len(devices)):
+            clients += [ws_client.WebSocket()]
+            clients[-1].connect("ws://127.0.0.1:28888")
+            data = dict(request["data"], seed=-1, width=request["data"]["width"] + 64 * i)
+            clients[-1].send_binary(bson.dumps({"type":"txt2img", "data":data}))
+        for c in clients:
+            assert run(None, c)
 
-server.stop()
+        client.send_binary(bson.dumps({"type":"stats", "data":{}}))
+        stats = bson.loads(client.recv())["data"]
+        # prefetching alone doesnt count, each worker has to have run a job
+        assert all(w["components"]["UNET"]["hits"] + w["components"]["UNET"]["misses"] for w in stats["workers"]), stats
+finally:
+    server.stop()
 
 display(image)
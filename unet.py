@@ -609,11 +609,13 @@ class UNET(nn.Module):
 
         return sample
 
-    def load_state_dict(self, state_dict, strict):
+    def convert_state_dict(self, state_dict):
         # replace the linear projections in v2
         for k in state_dict:
             if k.endswith(".weight") and "proj_" in k:
                 if len(state_dict[k].shape) == 2:
                     state_dict[k] = state_dict[k].unsqueeze(2).unsqueeze(2)
+        return state_dict
 
-        return super().load_state_dict(state_dict, strict)
\ No newline at end of file
+    def load_state_dict(self, state_dict, strict):
+        return super().load_state_dict(self.convert_state_dict(state_dict), strict)
\ No newline at end of file
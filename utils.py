@@ -1,10 +1,20 @@
 import PIL
+import io
+import threading
 import torch
 import torchvision.transforms as transforms
 
 TO_TENSOR = transforms.ToTensor()
 FROM_TENSOR = transforms.ToPILImage()
 
+# linear approximation of the VAE decoder, maps the 4 latent channels to RGB
+LATENT_RGB_FACTORS = torch.tensor([
+    [ 0.298,  0.207,  0.208],
+    [ 0.187,  0.286,  0.173],
+    [-0.158,  0.189,  0.264],
+    [-0.184, -0.271, -0.473],
+])
+
 def preprocess_images(images):
     def process(image):
         image = TO_TENSOR(image).to(torch.float32)
@@ -13,7 +23,7 @@ def preprocess_images(images):
 
 def postprocess_images(images):
     def process(image):
-        image = (image / 2 + 0.5).clamp(0, 1)
+        image = (image.to(torch.float32) / 2 + 0.5).clamp(0, 1)
         return FROM_TENSOR(image)
     return [process(i) for i in images]
 
@@ -50,6 +60,34 @@ def decode_images(vae, latents):
     images = vae.decode(latents).sample
     return postprocess_images(images)
 
+def preview_images(latents, size):
+    factors = LATENT_RGB_FACTORS.to(latents.device)
+    images = torch.einsum("bchw,cr->brhw", latents.to(torch.float32), factors)
+    images = ((images + 1) / 2).clamp(0, 1).cpu()
+
+    def process(image):
+        image = FROM_TENSOR(image)
+        scale = size / max(image.size)
+        return image.resize((int(image.size[0] * scale), int(image.size[1] * scale)), resample=PIL.Image.BILINEAR)
+    return [process(i) for i in images]
+
+def encode_image(image, format, quality, compress_level):
+    if format == "Raw":
+        return image.tobytes()
+
+    bytesio = io.BytesIO()
+    if format == "PNG":
+        image.save(bytesio, format="PNG", compress_level=6 if compress_level == None else compress_level)
+    elif format == "PNG (fast)":
+        image.save(bytesio, format="PNG", compress_level=1 if compress_level == None else compress_level)
+    elif format == "JPEG":
+        image.save(bytesio, format="JPEG", quality=quality)
+    elif format == "WebP":
+        image.save(bytesio, format="WEBP", quality=quality, method=compress_level or 0)
+    else:
+        raise ValueError(f"ERROR unknown format: {format}")
+    return bytesio.getvalue()
+
 def get_latents(vae, seeds, images):
     if type(images) == torch.Tensor:
         return images.to(vae.device)
@@ -134,10 +172,35 @@ def prepare_inpainting(originals, masks, padding):
 
     return images, masks, extents
 
+def load_state_dict(module, state_dict):
+    # tensors are assigned to the module rather than copied, so the weights only exist once
+    if hasattr(module, "convert_state_dict"):
+        module.convert_state_dict(state_dict)
+
+    missing = []
+    for k, v in module.state_dict(keep_vars=True).items():
+        if not k in state_dict or state_dict[k].shape != v.shape:
+            missing += [k]
+            continue
+        tensor = state_dict[k].to(v.dtype)
+        if v.device.type != "meta":
+            v.data = tensor
+            continue
+
+        # empty tensors cant take real data, they are replaced on their owning module
+        path, _, name = k.rpartition(".")
+        owner = module.get_submodule(path)
+        if name in owner._parameters:
+            owner._parameters[name] = torch.nn.Parameter(tensor, requires_grad=v.requires_grad)
+        else:
+            owner._buffers[name] = tensor
+    return missing
+
 def cast_state_dict(state_dict, dtype):
-    for k in state_dict:
-        if type(k) == torch.Tensor and k.dtype in {torch.float16, torch.float32}:
-            state_dict[k] = state_dict[k].to(dtype)
+    # one tensor at a time, each original is freed as soon as its cast replaces it
+    for k, v in state_dict.items():
+        if type(v) == torch.Tensor and v.dtype in {torch.float16, torch.bfloat16, torch.float32, torch.float64}:
+            state_dict[k] = v.to(dtype)
     return state_dict
 
 class NoiseSchedule():
@@ -220,20 +283,69 @@ def slerp_noise(val, low, high):
     res = (torch.sin((1.0-val)*omega)/so).unsqueeze(1)*low + (torch.sin(val*omega)/so).unsqueeze(1)*high
     return res
 
+class ThreadPatch:
+    # the patched function is installed once and dispatches on the calling thread, so workers
+    # building modules at the same time as a thread inside the context are unaffected
+    lock = threading.Lock()
+    originals = {}
+    local = threading.local()
+
+    def __init__(self, owner, name, replacement):
+        self.key = (owner, name)
+        self.replacement = replacement
+
+        with ThreadPatch.lock:
+            if self.key in ThreadPatch.originals:
+                return
+            original = getattr(owner, name)
+            ThreadPatch.originals[self.key] = original
+            key = self.key
+
+            def dispatch(*args, **kwargs):
+                active = getattr(ThreadPatch.local, "active", {}).get(key)
+                if active:
+                    return active[-1](original, *args, **kwargs)
+                return original(*args, **kwargs)
+
+            setattr(owner, name, dispatch)
+
+    def __enter__(self):
+        if not hasattr(ThreadPatch.local, "active"):
+            ThreadPatch.local.active = {}
+        ThreadPatch.local.active.setdefault(self.key, []).append(self.replacement)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        ThreadPatch.local.active[self.key].pop()
+
 class DisableInitialization:
     def __enter__(self):
-        def do_nothing(*args, **kwargs):
+        def do_nothing(original, *args, **kwargs):
             pass
 
-        self.init_kaiming_uniform = torch.nn.init.kaiming_uniform_
-        self.init_no_grad_normal = torch.nn.init._no_grad_normal_
+        self.patches = [
+            ThreadPatch(torch.nn.init, "kaiming_uniform_", do_nothing),
+            ThreadPatch(torch.nn.init, "_no_grad_normal_", do_nothing)
+        ]
+        for patch in self.patches:
+            patch.__enter__()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for patch in self.patches:
+            patch.__exit__(exc_type, exc_val, exc_tb)
+
+class EmptyInitialization:
+    # parameters are created on the meta device, so nothing is allocated until the weights are assigned
+    def __enter__(self):
+        def register_empty_parameter(register_parameter, module, name, param):
+            register_parameter(module, name, param)
+            if param is not None:
+                module._parameters[name] = torch.nn.Parameter(param.to("meta"), requires_grad=param.requires_grad)
 
-        torch.nn.init.kaiming_uniform_ = do_nothing
-        torch.nn.init._no_grad_normal_ = do_nothing
+        self.patch = ThreadPatch(torch.nn.Module, "register_parameter", register_empty_parameter)
+        self.patch.__enter__()
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        torch.nn.init.kaiming_uniform_ = self.init_kaiming_uniform
-        torch.nn.init._no_grad_normal_ = self.init_no_grad_normal
+        self.patch.__exit__(exc_type, exc_val, exc_tb)
 
 class CUDATimer:
     def __enter__(self):
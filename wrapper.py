@@ -3,6 +3,9 @@ import torchvision.transforms as transforms
 import PIL
 import random
 import io
+import threading
+import concurrent.futures
+import functools
 
 import prompts
 import samplers_k
@@ -12,11 +15,13 @@ import utils
 import storage
 import upscalers
 import inference
+import cache
 
 DEFAULTS = {
     "strength": 0.75, "sampler": "Euler_a", "clip_skip": 1, "eta": 1,
     "hr_upscale": "Latent (nearest)", "hr_strength": 0.7, "img2img_upscale": "Lanczos", "mask_blur": 4,
-    "lora_strength": 1.0, "hn_strength": 1.0
+    "lora_strength": 1.0, "hn_strength": 1.0, "preview_size": 256, "preview_quality": 75,
+    "format": "PNG", "quality": 90
 }
 
 SAMPLER_CLASSES = {
@@ -43,19 +48,48 @@ UPSCALERS_PIXEL = {
     "Nearest": transforms.InterpolationMode.NEAREST,
 }
 
+IMAGE_FORMATS = ["PNG", "PNG (fast)", "JPEG", "WebP", "Raw"]
+
+# parameters that must match for txt2img requests to share a batch
+BATCH_PARAMETERS = "model, unet, clip, vae, sampler, width, height, steps, scale, clip_skip, eta, hr_factor, hr_steps, hr_upscale, hr_strength, hr_sampler, hr_eta, lora, lora_strength, hn, hn_strength, preview_interval, preview_size, preview_quality, format, quality, compress_level".split(", ")
+
+# attributes that persist across requests
+INTERNAL_ATTRIBUTES = "storage, device, cache, callback, interrupt, encoder, encoder_slots, conditioning_cache".split(", ")
+
+# parameters that only change how results are delivered, not the images themselves
+DELIVERY_PARAMETERS = "format, quality, compress_level, preview_interval, preview_size, preview_quality".split(", ")
+
+# parameters that are per image, these get concatenated when merging
+IMAGE_PARAMETERS = "prompt, negative_prompt, seed, subseed, batch_size".split(", ")
+
 class GenerationParameters():
-    def __init__(self, storage: storage.ModelStorage, device):
+    def __init__(self, storage: storage.ModelStorage, device, encoder_threads=2, encoder_limit=8, cache=None):
         self.storage = storage
         self.device = device
+        self.cache = cache
 
         self.callback = None
+        self.interrupt = threading.Event()
+
+        # images are encoded in the background, at most encoder_limit can be waiting
+        self.encoder = concurrent.futures.ThreadPoolExecutor(encoder_threads)
+        self.encoder_slots = threading.BoundedSemaphore(encoder_limit)
+
+        # CLIP encodings of prompt chunks, common negative prompts are reused by most jobs
+        self.conditioning_cache = prompts.ConditioningCache()
+
+    def check_interrupt(self):
+        if self.interrupt.is_set():
+            raise RuntimeError("Aborted")
 
     def set_status(self, status):
+        self.check_interrupt()
         if self.callback:
             if not self.callback({"type": "status", "data": {"message": status}}):
                 raise RuntimeError("Aborted")
 
     def set_progress(self, current, total):
+        self.check_interrupt()
         if self.callback:
             if not self.callback({"type": "progress", "data": {"current": current, "total": total}}):
                 raise RuntimeError("Aborted")
@@ -64,20 +98,54 @@ class GenerationParameters():
         if step:
             self.current_step += 1
         self.set_progress(self.current_step, self.total_steps)
-    
-    def on_complete(self, images):
+
+        if self.preview_interval and step and self.current_step % self.preview_interval == 0:
+            self.on_preview(utils.preview_images(latents, self.preview_size))
+
+    def on_preview(self, images):
         if self.callback:
             images_data = []
             for i in images:
                 bytesio = io.BytesIO()
-                i.save(bytesio, format='PNG')
+                i.save(bytesio, format='JPEG', quality=self.preview_quality)
                 images_data += [bytesio.getvalue()]
-            self.callback({"type": "result", "data": {"images": images_data}})
+            if not self.callback({"type": "preview", "data": {"images": images_data, "step": self.current_step}}):
+                raise RuntimeError("Aborted")
+    
+    def on_image(self, index, total, image):
+        if self.callback:
+            # encode off the inference thread so the next job can start
+            self.encoder_slots.acquire()
+            self.encoder.submit(self.send_image, self.callback, index, total, image, self.format, self.quality, self.compress_level)
+
+    def send_image(self, callback, index, total, image, format, quality, compress_level):
+        try:
+            data = {"images": [utils.encode_image(image, format, quality, compress_level)], "index": index, "total": total, "format": format}
+            if format == "Raw":
+                data.update(width=image.size[0], height=image.size[1], mode=image.mode)
+            callback({"type": "result", "data": data})
+        except Exception as e:
+            callback({"type": "error", "data": {"message": str(e)}})
+        finally:
+            self.encoder_slots.release()
+
+    def decode_images(self, latents, postprocess=None):
+        # decode one image at a time so each can be sent as soon as its ready
+        images = []
+        for i in range(len(latents)):
+            self.check_interrupt()
+            image = utils.decode_images(self.vae, latents[i:i+1])[0]
+            if postprocess:
+                image = postprocess(i, image)
+            self.on_image(i, len(latents), image)
+            images += [image]
+        return images
 
     def reset(self):
         self.storage.find_all()
+        self.storage.clear_in_use()
         for attr in list(self.__dict__.keys()):
-            if not attr in ["storage", "device", "callback"]:
+            if not attr in INTERNAL_ATTRIBUTES:
                 delattr(self, attr)
 
     def __getattr__(self, item):
@@ -96,8 +164,9 @@ class GenerationParameters():
         
         if not self.clip or type(self.clip) == str:
             self.set_status("Loading CLIP")
+            self.clip_key = self.storage.get_key(self.clip or self.model, "CLIP")
             self.clip = self.storage.get_clip(self.clip or self.model, self.device)
-            self.clip.set_textual_inversions(self.storage.get_embeddings(self.device))
+            self.clip.set_textual_inversions(self.storage.get_embedding_names(), functools.partial(self.storage.get_embedding, device=self.device))
         
         if not self.vae or type(self.vae) == str:
             self.set_status("Loading VAE")
@@ -115,13 +184,16 @@ class GenerationParameters():
                 self.set_status("Loading Upscaler")
                 self.upscale_model = self.storage.get_upscaler(self.img2img_upscale, self.device)
 
+    def set_defaults(self):
+        for attr, value in DEFAULTS.items():
+            if getattr(self, attr) == None:
+                setattr(self, attr, value)
+
     def check_parameters(self, required, optional):
         missing, unused = list(required), []
         other = "storage, device, model".split(", ")
 
-        for attr, value in DEFAULTS.items():
-            if getattr(self, attr) == None:
-                setattr(self, attr, value)
+        self.set_defaults()
 
         for attr in self.__dict__.keys():
             if attr in required:
@@ -137,10 +209,14 @@ class GenerationParameters():
         if not self.sampler in SAMPLER_CLASSES:
             raise ValueError(f"ERROR unknown sampler: {self.sampler}")
 
+        if not self.format in IMAGE_FORMATS:
+            raise ValueError(f"ERROR unknown format: {self.format}")
+
         if (self.width or self.height) and not (self.width and self.height):
             raise ValueError("ERROR width and height must both be set")
 
-    def listify(self, *args):
+    @staticmethod
+    def listify(*args):
         if args == None:
             return (None,)
         args = [[a] if type(a) != list else a for a in args]
@@ -174,9 +250,15 @@ class GenerationParameters():
         return latents
 
     def get_seeds(self, batch_size):
-        (seeds,) = self.listify(self.seed)
-        if self.subseed:
-            (subseeds,) = self.listify(self.subseed)
+        return self.expand_seeds(self.seed, self.subseed, batch_size)
+
+    @staticmethod
+    def expand_seeds(seed, subseed, batch_size):
+        (seeds,) = GenerationParameters.listify(seed)
+        seeds = list(seeds)
+        if subseed:
+            (subseeds,) = GenerationParameters.listify(subseed)
+            subseeds = list(subseeds)
         else:
             subseeds = [(0,0)]
 
@@ -200,7 +282,11 @@ class GenerationParameters():
         return seeds, subseeds, batch_size
 
     def get_prompts(self, batch_size):
-        (prompts, negative_prompts) = self.listify(self.prompt, self.negative_prompt)
+        return self.expand_prompts(self.prompt, self.negative_prompt, batch_size)
+
+    @staticmethod
+    def expand_prompts(prompt, negative_prompt, batch_size):
+        (prompts, negative_prompts) = GenerationParameters.listify(prompt, negative_prompt)
         batch_size = max(batch_size or 0, len(prompts), len(negative_prompts))
         return prompts, negative_prompts, batch_size
 
@@ -222,6 +308,12 @@ class GenerationParameters():
             for i, lora in enumerate(self.loras):
                 lora.set_strength(lora_strengths[i])
                 lora.attach(self.unet.additional, self.clip.additional)
+
+            # LoRAs with text encoder modules change the conditioning
+            self.text_loras = []
+            for name, lora, strength in zip(lora_names, self.loras, lora_strengths):
+                if any(n.startswith("lora_te") for n, _ in lora.named_children()):
+                    self.text_loras += [(tuple(self.storage.get_identity(name, "LoRA")), strength)]
         else:
             self.storage.enforce_network_limit([], "LoRA")
 
@@ -241,18 +333,186 @@ class GenerationParameters():
         else:
             self.storage.enforce_network_limit([], "HN")
 
+    def get_conditioning_key(self):
+        if not self.clip_key:
+            return None
+        return (self.clip_key, tuple(self.text_loras or []))
+
     def detach_networks(self):
         self.unet.additional.clear()
         self.clip.additional.clear()
 
-    @torch.inference_mode()
+    @staticmethod
+    def get_batch_key(request):
+        if request["type"] != "txt2img":
+            return None
+
+        data = request["data"]
+        if any(not k in BATCH_PARAMETERS and not k in IMAGE_PARAMETERS for k in data):
+            return None
+
+        # a request with bad per image parameters runs on its own, so only its client gets the error
+        try:
+            GenerationParameters.expand_images(data)
+        except Exception:
+            return None
+
+        return tuple(repr(data.get(k, DEFAULTS.get(k))) for k in BATCH_PARAMETERS)
+
+    @staticmethod
+    def get_number(data, key, default):
+        # estimates run on the raw request before its validated, so reject anything that isnt a number
+        value = data.get(key) or default
+        if not type(value) in [int, float]:
+            raise ValueError(f"ERROR {key} must be a number")
+        return value
+
+    @staticmethod
+    def get_batch_size(request):
+        data = request["data"]
+        lengths = GenerationParameters.listify(data.get("prompt"), data.get("negative_prompt"), data.get("seed"), data.get("subseed"))
+        return max([GenerationParameters.get_number(data, "batch_size", 1)] + [len(l) for l in lengths])
+
+    @staticmethod
+    def get_models(request):
+        data = request["data"]
+        model = data.get("model")
+        return {"UNET": data.get("unet") or model, "CLIP": data.get("clip") or model, "VAE": data.get("vae") or model}
+
+    @staticmethod
+    def get_prefetch(request):
+        # every model file a request will load, for loading ahead of time
+        data = request["data"]
+        models = {comp: [name] for comp, name in GenerationParameters.get_models(request).items()}
+        (models["LoRA"], models["HN"]) = GenerationParameters.listify(data.get("lora"), data.get("hn"))
+        return {comp: [n for n in names if type(n) == str] for comp, names in models.items()}
+
+    @staticmethod
+    def get_cost(request):
+        # rough amount of work in 512x512 image steps
+        data = request["data"]
+        number = functools.partial(GenerationParameters.get_number, data)
+        width, height = number("width", 512), number("height", 512)
+        size = GenerationParameters.get_batch_size(request)
+        steps = number("steps", 0)
+
+        if request["type"] == "img2img":
+            steps *= number("strength", DEFAULTS["strength"])
+
+        cost = steps * width * height
+        if data.get("hr_factor"):
+            cost += number("hr_steps", steps) * width * height * number("hr_factor", 0) ** 2
+        return size * cost / (512 * 512)
+
+    @staticmethod
+    def expand_images(data):
+        # explicit prompts and seeds of every image in the request
+        batch_size, seed, subseed = data.get("batch_size"), data.get("seed"), data.get("subseed")
+        if batch_size != None and type(batch_size) != int:
+            raise ValueError("ERROR batch_size must be an integer")
+        (seeds, subseeds) = GenerationParameters.listify(seed, subseed or [])
+        if any(type(s) != int for s in seeds):
+            raise ValueError("ERROR seed must be an integer")
+        if any(type(s) not in [list, tuple] or len(s) != 2 or type(s[0]) != int or not type(s[1]) in [int, float] for s in subseeds):
+            raise ValueError("ERROR subseed must be a seed and strength")
+
+        positive, negative, batch_size = GenerationParameters.expand_prompts(data.get("prompt"), data.get("negative_prompt"), batch_size)
+        if any(type(p) != str for p in positive + negative):
+            raise ValueError("ERROR prompts must be strings")
+        seeds, subseeds, batch_size = GenerationParameters.expand_seeds(seed, subseed, batch_size)
+
+        positive = [positive[i % len(positive)] for i in range(batch_size)]
+        negative = [negative[i % len(negative)] for i in range(batch_size)]
+        return positive, negative, seeds[:batch_size], subseeds[:batch_size]
+
+    @staticmethod
+    def merge_requests(requests):
+        # expand each request into explicit per image prompts and seeds, then concatenate them
+        prompts, negative_prompts, seeds, subseeds, sizes = [], [], [], [], []
+        for request in requests:
+            positive, negative, seed, subseed = GenerationParameters.expand_images(request["data"])
+            prompts += positive
+            negative_prompts += negative
+            seeds += seed
+            subseeds += subseed
+            sizes += [len(seed)]
+
+        data = dict(requests[0]["data"])
+        data.update(prompt=prompts, negative_prompt=negative_prompts, seed=seeds, subseed=subseeds, batch_size=sum(sizes))
+        return {"type": "txt2img", "data": data}, sizes
+
+    def get_cache_key(self, mode):
+        if not self.cache:
+            return None
+
+        params = {k: v for k, v in self.__dict__.items() if not k in INTERNAL_ATTRIBUTES + DELIVERY_PARAMETERS}
+        for attr, value in DEFAULTS.items():
+            if params.get(attr) == None and not attr in DELIVERY_PARAMETERS:
+                params[attr] = value
+
+        # random seeds are only known once generation starts
+        (seeds,) = self.listify(self.seed)
+        (subseeds,) = self.listify(self.subseed or [])
+        if any(s == None or s == -1 for s in seeds) or any(type(s) in [list, tuple] and s[0] == -1 for s in subseeds):
+            return None
+
+        # identify models by their files so replacing a file invalidates results
+        identities = {}
+        for comp, name in self.get_models({"data": params}).items():
+            if type(name) != str:
+                return None
+            identities[comp] = self.storage.get_identity(name, comp)
+        for comp, attr in [("LoRA", "lora"), ("HN", "hn"), ("SR", "hr_upscale"), ("SR", "img2img_upscale")]:
+            (names,) = self.listify(params.get(attr))
+            identities[attr] = [self.storage.get_identity(name, comp) for name in names]
+        (positives, negatives) = self.listify(self.prompt, self.negative_prompt)
+        identities["TI"] = self.storage.get_embedding_identities(" ".join(str(p) for p in positives + negatives))
+
+        params.update(mode=mode, models=identities)
+        try:
+            return cache.get_key(params)
+        except ValueError:
+            return None
+
+    def run_cached(self, mode, generate):
+        key = self.get_cache_key(mode)
+        if not key:
+            return generate()
+
+        # identical jobs running elsewhere are waited on rather than generated twice
+        images = self.cache.get(key)
+        if images != None:
+            # generation never ran, so the delivery parameters are still unchecked
+            self.set_defaults()
+            if not self.format in IMAGE_FORMATS:
+                raise ValueError(f"ERROR unknown format: {self.format}")
+            self.set_status("Cached")
+            for i, image in enumerate(images):
+                self.on_image(i, len(images), image)
+            return images
+
+        try:
+            images = generate()
+        except BaseException:
+            self.cache.cancel(key)
+            raise
+        self.cache.put(key, images)
+        return images
+
     def txt2img(self):
+        return self.run_cached("txt2img", self.generate_txt2img)
+
+    def img2img(self):
+        return self.run_cached("img2img", self.generate_img2img)
+
+    @torch.inference_mode()
+    def generate_txt2img(self):
         self.set_status("Loading")
         self.load_models()
 
         self.set_status("Configuring")
         required = "unet, clip, vae, sampler, prompt, negative_prompt, width, height, seed, scale, steps".split(", ")
-        optional = "clip_skip, eta, batch_size, hr_steps, hr_factor, hr_upscale, hr_strength, hr_sampler, hr_eta, lora, hn".split(", ")
+        optional = "clip_skip, eta, batch_size, hr_steps, hr_factor, hr_upscale, hr_strength, hr_sampler, hr_eta, lora, hn, preview_interval, preview_size, preview_quality, format, quality, compress_level".split(", ")
         self.check_parameters(required, optional)
 
         device = self.unet.device
@@ -272,8 +532,8 @@ class GenerationParameters():
         if not self.hr_eta:
             self.hr_eta = self.eta
 
-        conditioning = prompts.ConditioningSchedule(self.clip, positive_prompts, negative_prompts, self.steps, self.clip_skip, batch_size)
-        denoiser = guidance.GuidedDenoiser(self.unet, conditioning, self.scale)
+        conditioning = prompts.ConditioningSchedule(self.clip, positive_prompts, negative_prompts, self.steps, self.clip_skip, batch_size, self.conditioning_cache, self.get_conditioning_key())
+        denoiser = guidance.GuidedDenoiser(self.unet, conditioning, self.scale, self.check_interrupt)
         noise = utils.NoiseSchedule(seeds, subseeds, self.width // 8, self.height // 8, device, self.unet.dtype)
         sampler = SAMPLER_CLASSES[self.sampler](denoiser, self.eta)
         
@@ -281,9 +541,7 @@ class GenerationParameters():
         latents = inference.txt2img(denoiser, sampler, noise, self.steps, self.on_step)
 
         if not self.hr_factor:
-            images = utils.decode_images(self.vae, latents)
-            self.on_complete(images)
-            return images
+            return self.decode_images(latents)
 
         width = int(self.width * self.hr_factor)
         height = int(self.height * self.hr_factor)
@@ -299,18 +557,16 @@ class GenerationParameters():
         self.set_status("Generating")
         latents = inference.img2img(latents, denoiser, sampler, noise, hr_steps, True, self.hr_strength, self.on_step)
 
-        images = utils.decode_images(self.vae, latents)
-        self.on_complete(images)
-        return images
+        return self.decode_images(latents)
 
     @torch.inference_mode()
-    def img2img(self):
+    def generate_img2img(self):
         self.set_status("Loading")
         self.load_models()
 
         self.set_status("Configuring")
         required = "unet, clip, vae, sampler, image, prompt, negative_prompt, seed, scale, steps, strength".split(", ")
-        optional = "img2img_upscale, mask, mask_blur, clip_skip, eta, batch_size, padding, width, height, lora".split(", ")
+        optional = "img2img_upscale, mask, mask_blur, clip_skip, eta, batch_size, padding, width, height, lora, preview_interval, preview_size, preview_quality, format, quality, compress_level".split(", ")
         self.check_parameters(required, optional)
 
         device = self.unet.device
@@ -334,8 +590,8 @@ class GenerationParameters():
         self.current_step = 0
         self.total_steps = int(self.steps * self.strength) + 1
             
-        conditioning = prompts.ConditioningSchedule(self.clip, positive_prompts, negative_prompts, self.steps, self.clip_skip, batch_size)
-        denoiser = guidance.GuidedDenoiser(self.unet, conditioning, self.scale)
+        conditioning = prompts.ConditioningSchedule(self.clip, positive_prompts, negative_prompts, self.steps, self.clip_skip, batch_size, self.conditioning_cache, self.get_conditioning_key())
+        denoiser = guidance.GuidedDenoiser(self.unet, conditioning, self.scale, self.check_interrupt)
         noise = utils.NoiseSchedule(seeds, subseeds, width // 8, height // 8, device, self.unet.dtype)
         sampler = SAMPLER_CLASSES[self.sampler](denoiser, self.eta)
 
@@ -355,12 +611,12 @@ class GenerationParameters():
         self.set_status("Generating")
         latents = inference.img2img(latents, denoiser, sampler, noise, self.steps, False, self.strength, self.on_step)
 
-        images = utils.decode_images(self.vae, latents)
-
+        postprocess = None
         if self.mask:
-            images = utils.apply_inpainting(images, original_images, masks, extents)
+            def postprocess(i, image):
+                original, mask, extent = original_images[i%len(original_images)], masks[i%len(masks)], extents[i%len(extents)]
+                return utils.apply_inpainting([image], [original], [mask], [extent])[0]
 
-        self.on_complete(images)
-        return images
+        return self.decode_images(latents, postprocess)
 
 